@@ -27,8 +27,10 @@ class AgentIdentity(BaseModel):
     skills: Dict[str, float] = Field(default_factory=dict) # e.g., {"farming": 0.2, "crafting": 0.1}
 
 class Agent:
-    def __init__(self, name: str, personality: str):
+    def __init__(self, name: str, personality: str, agent_id: Optional[str] = None):
         self.identity = AgentIdentity(name=name, personality=personality)
+        if agent_id is not None:
+            self.identity.agent_id = agent_id
         self.state = AgentState()
         self.memory = None # Will be injected
 
@@ -0,0 +1,244 @@
+"""
+Analytics - simulation_events の集計ロールアップ (増分更新) モジュール
+
+「時代ごとの伝説の数」「100ターンあたりのエージェント別行動数」「フォールバック率の推移」
+といった集計を、simulation_events の全件スキャン無しに答えるためのロールアップ。
+
+- SimulationEvent が flush されるたびに、同じトランザクション内で
+  (ターンバケット × event_type × agent_id) ごとの件数・本文長合計を加算する
+- LLM フォールバックで保存されなかった行動は record_fallback で件数のみ加算する
+- /api/stats と epoch_detector はロールアップだけを読むので、履歴の長さに依存しない
+
+既存の履歴からの再構築: `python analytics.py rebuild`
+"""
+from collections import defaultdict
+from typing import Optional, Iterable
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from database import SessionLocal
+import models
+
+ROLLUP_BUCKET_TURNS = 10  # ロールアップの最小粒度 (ターン数)。変更時は rebuild が必要
+
+_Rollup = models.EventRollup
+
+
+def bucket_of(turn: int) -> int:
+    return (turn // ROLLUP_BUCKET_TURNS) * ROLLUP_BUCKET_TURNS
+
+
+def _upsert(conn, counts: dict, replace: bool = False):
+    """
+    Add (or with replace=True, overwrite event/length) counters keyed by
+    (bucket_start, event_type, agent_id). counts values: [events, fallbacks, length_sum].
+    """
+    if not counts:
+        return
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        insert = postgresql.insert
+    elif dialect == "sqlite":
+        insert = sqlite.insert
+    else:
+        print(f"[Analytics] Rollups are not supported on '{dialect}'.")
+        return
+
+    rows = [
+        {
+            "bucket_start": bucket_start,
+            "event_type": event_type,
+            "agent_id": agent_id,
+            "event_count": n_events,
+            "fallback_count": n_fallbacks,
+            "content_length_sum": length_sum,
+        }
+        for (bucket_start, event_type, agent_id), (n_events, n_fallbacks, length_sum) in counts.items()
+    ]
+    stmt = insert(_Rollup.__table__).values(rows)
+    table = _Rollup.__table__.c
+    if replace:
+        update = {
+            "event_count": stmt.excluded.event_count,
+            "content_length_sum": stmt.excluded.content_length_sum,
+        }
+    else:
+        update = {
+            "event_count": table.event_count + stmt.excluded.event_count,
+            "fallback_count": table.fallback_count + stmt.excluded.fallback_count,
+            "content_length_sum": table.content_length_sum + stmt.excluded.content_length_sum,
+        }
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=["bucket_start", "event_type", "agent_id"], set_=update
+    ))
+
+
+def _count_events(events: Iterable, counts: Optional[dict] = None) -> dict:
+    counts = counts if counts is not None else defaultdict(lambda: [0, 0, 0])
+    for ev in events:
+        if ev.turn is None:
+            continue
+        key = (bucket_of(ev.turn), ev.event_type, ev.agent_id)
+        counts[key][0] += 1
+        counts[key][2] += len(ev.content or "")
+    return counts
+
+
+@event.listens_for(Session, "after_flush")
+def _rollup_after_flush(session, flush_context):
+    """Fold newly inserted SimulationEvents into the rollups inside the same transaction."""
+    new_events = [obj for obj in session.new if isinstance(obj, models.SimulationEvent)]
+    if new_events:
+        _upsert(session.connection(), _count_events(new_events))
+
+
+def record_fallback(db, turn: int, agent_id: str, event_type: str):
+    """Count an LLM fallback that was skipped instead of being saved as an event."""
+    _upsert(db.connection(), {(bucket_of(turn), event_type, agent_id): [0, 1, 0]})
+
+
+def count_events(
+    db,
+    turn_start: int,
+    turn_end: int,
+    event_type: Optional[str] = None,
+    agent_id: Optional[str] = None,
+) -> int:
+    """
+    Number of events in the buckets overlapping [turn_start, turn_end).
+    Exact when both bounds are multiples of ROLLUP_BUCKET_TURNS, an over-estimate otherwise.
+    """
+    q = db.query(func.coalesce(func.sum(_Rollup.event_count), 0)).filter(
+        _Rollup.bucket_start >= bucket_of(turn_start),
+        _Rollup.bucket_start < turn_end,
+    )
+    if event_type is not None:
+        q = q.filter(_Rollup.event_type == event_type)
+    if agent_id is not None:
+        q = q.filter(_Rollup.agent_id == agent_id)
+    return int(q.scalar())
+
+
+def get_series(
+    db,
+    bucket: int = 100,
+    event_type: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    group_by: Optional[str] = None,
+) -> list:
+    """
+    Time series aggregated to `bucket` turns (a multiple of ROLLUP_BUCKET_TURNS),
+    optionally split by "event_type" or "agent_id".
+    """
+    if bucket <= 0 or bucket % ROLLUP_BUCKET_TURNS != 0:
+        raise ValueError(f"bucket must be a positive multiple of {ROLLUP_BUCKET_TURNS}")
+    if group_by not in (None, "event_type", "agent_id"):
+        raise ValueError("group_by must be 'event_type' or 'agent_id'")
+
+    bucket_col = ((_Rollup.bucket_start // bucket) * bucket).label("bucket_start")
+    columns = [
+        bucket_col,
+        func.sum(_Rollup.event_count).label("event_count"),
+        func.sum(_Rollup.fallback_count).label("fallback_count"),
+        func.sum(_Rollup.content_length_sum).label("content_length_sum"),
+    ]
+    group_cols = [bucket_col]
+    if group_by is not None:
+        key_col = getattr(_Rollup, group_by)
+        columns.append(key_col)
+        group_cols.append(key_col)
+
+    q = db.query(*columns)
+    if event_type is not None:
+        q = q.filter(_Rollup.event_type == event_type)
+    if agent_id is not None:
+        q = q.filter(_Rollup.agent_id == agent_id)
+    if turn_start is not None:
+        q = q.filter(_Rollup.bucket_start >= bucket_of(turn_start))
+    if turn_end is not None:
+        q = q.filter(_Rollup.bucket_start < turn_end)
+    rows = q.group_by(*group_cols).order_by(bucket_col).all()
+
+    series = []
+    for row in rows:
+        events, fallbacks = int(row.event_count or 0), int(row.fallback_count or 0)
+        point = {
+            "bucket_start": int(row.bucket_start),
+            "event_count": events,
+            "fallback_count": fallbacks,
+            "fallback_rate": fallbacks / (events + fallbacks) if events + fallbacks else 0.0,
+            "avg_content_length": int(row.content_length_sum or 0) / events if events else 0.0,
+        }
+        if group_by is not None:
+            point[group_by] = getattr(row, group_by)
+        series.append(point)
+    return series
+
+
+def ensure_rollups():
+    """Backfill the rollups once if events exist but nothing has been rolled up yet."""
+    db = SessionLocal()
+    try:
+        has_rollups = db.query(_Rollup.id).first() is not None
+        has_events = db.query(models.SimulationEvent.id).first() is not None
+    except Exception as e:
+        print(f"[Analytics] Could not check rollups: {e}")
+        return
+    finally:
+        db.close()
+    if has_events and not has_rollups:
+        print("[Analytics] Rollups are empty. Rebuilding from history...")
+        rebuild_rollups()
+
+
+def rebuild_rollups():
+    """Recompute event counts from the full history (hot table + archive). Fallback counts are kept."""
+    from event_archive import _load_manifest, _read_segment, archived_turn_end
+
+    db = SessionLocal()
+    try:
+        # One segment in memory at a time; the archive can be far larger than RAM
+        counts = defaultdict(lambda: [0, 0, 0])
+        for seg in _load_manifest():
+            _count_events(_read_segment(seg["file"]), counts)
+        archive_end = archived_turn_end()
+        bucket_col = ((models.SimulationEvent.turn // ROLLUP_BUCKET_TURNS) * ROLLUP_BUCKET_TURNS).label("bucket_start")
+        hot = (
+            db.query(
+                bucket_col,
+                models.SimulationEvent.event_type,
+                models.SimulationEvent.agent_id,
+                func.count(models.SimulationEvent.id),
+                func.coalesce(func.sum(func.length(models.SimulationEvent.content)), 0),
+            )
+            .filter(models.SimulationEvent.turn.isnot(None))
+            .filter(models.SimulationEvent.turn >= archive_end)  # Rows the archive already holds
+            .group_by(bucket_col, models.SimulationEvent.event_type, models.SimulationEvent.agent_id)
+            .all()
+        )
+        for bucket_start, event_type, agent_id, n, length_sum in hot:
+            entry = counts[(int(bucket_start), event_type, agent_id)]
+            entry[0] += int(n)
+            entry[2] += int(length_sum)
+
+        db.query(_Rollup).update({_Rollup.event_count: 0, _Rollup.content_length_sum: 0})
+        _upsert(db.connection(), counts, replace=True)
+        db.commit()
+        print(f"[Analytics] Rebuilt {len(counts)} rollup rows.")
+    except Exception as e:
+        db.rollback()
+        print(f"[Analytics] Rebuild failed: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild":
+        rebuild_rollups()
+    else:
+        print("Usage: python analytics.py rebuild")
+        sys.exit(1)
@@ -0,0 +1,253 @@
+"""
+Checkpoint - シミュレーション全体の状態を定期保存し、再起動時に高速復帰するモジュール
+
+_resume_turn はターン番号しか復元しないため、再起動のたびにエージェントの agent_id が
+新しい uuid になり、既存のイベントや ChromaDB の記憶が孤立してしまう。
+
+保存内容: エージェントの identity (agent_id) / AgentState / Needs / short_term 記憶、
+乱数生成器の状態、LLM ルーターの状態 (replay の再生位置)、次に実行するターン番号。
+
+- フォーマット: 固定長ヘッダ (magic, version, 種別, seq, base_seq, crc32) + zlib 圧縮 JSON
+- 書き込み: 一時ファイル + fsync + os.replace による原子的な置き換え
+- FULL_EVERY 回に1回フルスナップショット、その間はベースから変化したエージェントだけの
+  差分スナップショット。復帰時は「最新のフル + それを基にした最新の差分」の2ファイルだけを読む
+- 最新のフルが壊れていた場合に備えて、1つ前のフルとその最新の差分も残しておく
+"""
+import os
+import json
+import zlib
+import struct
+import hashlib
+from typing import Optional, List
+from agent import Agent, AgentIdentity, AgentState
+from memory import MemoryItem
+
+CHECKPOINT_DIR = os.getenv(
+    "CHECKPOINT_DIR", os.path.join(os.path.dirname(__file__), "checkpoints")
+)
+CHECKPOINT_INTERVAL = int(os.getenv("CHECKPOINT_INTERVAL", "1"))  # N ターンごとに保存
+FULL_EVERY = int(os.getenv("CHECKPOINT_FULL_EVERY", "20"))  # 差分 N-1 回ごとにフルスナップショット
+
+_MAGIC = b"ECKP"
+_VERSION = 1
+_KIND_FULL, _KIND_DELTA = 0, 1
+_HEADER = struct.Struct("<4sBBIII")  # magic, version, kind, seq, base_seq, crc32
+
+
+def serialize_agent(agent: Agent) -> dict:
+    return {
+        "identity": agent.identity.model_dump(),
+        "state": agent.state.model_dump(),
+        "short_term": [m.model_dump() for m in agent.memory.short_term] if agent.memory else [],
+    }
+
+
+def restore_agent(data: dict) -> tuple:
+    """Rebuild an Agent (without its MemorySystem). Returns (agent, short_term items)."""
+    identity = AgentIdentity(**data["identity"])
+    agent = Agent(identity.name, identity.personality, agent_id=identity.agent_id)
+    agent.identity = identity
+    agent.state = AgentState(**data["state"])
+    return agent, [MemoryItem(**m) for m in data["short_term"]]
+
+
+def _rng_state_to_json(state: tuple) -> list:
+    version, internal, gauss_next = state
+    return [version, list(internal), gauss_next]
+
+
+def _rng_state_from_json(data: list) -> tuple:
+    version, internal, gauss_next = data
+    return (version, tuple(internal), gauss_next)
+
+
+def _digest(data: dict) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Checkpointer:
+    def __init__(self, directory: str = CHECKPOINT_DIR, interval: int = CHECKPOINT_INTERVAL,
+                 full_every: int = FULL_EVERY):
+        self.directory = directory
+        self.interval = max(1, interval)
+        self.full_every = max(1, full_every)
+        self._seq = 0
+        self._base_seq: Optional[int] = None
+        self._base_digests: dict = {}
+        self._since_full = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan_existing()
+
+    # ─── File layout ──────────────────────────────────────────
+
+    def _path(self, kind: int, seq: int) -> str:
+        prefix = "full" if kind == _KIND_FULL else "delta"
+        return os.path.join(self.directory, f"{prefix}_{seq:010d}.ckpt")
+
+    def _files(self) -> List[tuple]:
+        """Return [(kind, seq, path)] sorted by seq."""
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".ckpt"):
+                continue
+            prefix, _, rest = name.partition("_")
+            kind = {"full": _KIND_FULL, "delta": _KIND_DELTA}.get(prefix)
+            if kind is None:
+                continue
+            try:
+                seq = int(rest.split(".")[0])
+            except ValueError:
+                continue
+            files.append((kind, seq, os.path.join(self.directory, name)))
+        return sorted(files, key=lambda f: f[1])
+
+    def _scan_existing(self):
+        files = self._files()
+        if files:
+            self._seq = files[-1][1]
+
+    def _write(self, kind: int, base_seq: int, payload: dict) -> str:
+        self._seq += 1
+        body = zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"), 6)
+        header = _HEADER.pack(_MAGIC, _VERSION, kind, self._seq, base_seq, zlib.crc32(body))
+        path = self._path(kind, self._seq)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.directory)
+        return path
+
+    @staticmethod
+    def _read(path: str) -> tuple:
+        """Return (kind, seq, base_seq, payload). Raises ValueError on corrupt files."""
+        with open(path, "rb") as f:
+            raw = f.read()
+        if len(raw) < _HEADER.size:
+            raise ValueError(f"truncated checkpoint {path}")
+        magic, version, kind, seq, base_seq, crc = _HEADER.unpack_from(raw)
+        body = raw[_HEADER.size:]
+        if magic != _MAGIC or version != _VERSION or zlib.crc32(body) != crc:
+            raise ValueError(f"corrupt checkpoint {path}")
+        return kind, seq, base_seq, json.loads(zlib.decompress(body))
+
+    # ─── Save ─────────────────────────────────────────────────
+
+    def save(self, sim, force: bool = False) -> Optional[str]:
+        """Snapshot `sim` (after a step, so sim.turn is the next turn to run)."""
+        if not force and sim.turn % self.interval != 0:
+            return None
+        try:
+            agents = [serialize_agent(a) for a in sim.agents]
+            digests = {a["identity"]["agent_id"]: _digest(a) for a in agents}
+            common = {
+                "turn": sim.turn,
+                "seed": sim.seed,
+                "rng": _rng_state_to_json(sim.rng.getstate()),
+                "router": sim.router.get_state(),
+                "order": [a["identity"]["agent_id"] for a in agents],
+            }
+
+            if self._base_seq is None or self._since_full >= self.full_every - 1:
+                path = self._write(_KIND_FULL, 0, {**common, "since_full": 0, "agents": agents})
+                self._base_seq = self._seq
+                self._base_digests = digests
+                self._since_full = 0
+            else:
+                changed = [a for a in agents if self._base_digests.get(a["identity"]["agent_id"]) != digests[a["identity"]["agent_id"]]]
+                path = self._write(
+                    _KIND_DELTA, self._base_seq, {**common, "since_full": self._since_full + 1, "agents": changed}
+                )
+                self._since_full += 1
+            self._prune()
+            return path
+        except Exception as e:
+            print(f"[Checkpoint] Save failed at turn {sim.turn}: {e}")
+            return None
+
+    @staticmethod
+    def _base_of(path: str) -> Optional[int]:
+        """base_seq from a delta's header, None if it cannot be read."""
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_HEADER.size)
+            return _HEADER.unpack(header)[4]
+        except (OSError, struct.error):
+            return None
+
+    def _prune(self):
+        """
+        Keep the newest two full snapshots (plus the current base) and the newest delta
+        based on each, so load() can fall back to the previous pair if the newest is corrupt.
+        """
+        files = self._files()
+        fulls = [seq for kind, seq, _ in files if kind == _KIND_FULL]
+        bases = set(fulls[-2:]) | {self._base_seq}
+        keep = set(bases)
+        newest_delta = {}
+        for kind, seq, path in files:
+            if kind == _KIND_DELTA:
+                base = self._base_of(path)
+                if base in bases:
+                    newest_delta[base] = seq  # files are sorted by seq
+        keep.update(newest_delta.values())
+        for kind, seq, path in files:
+            if seq not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # ─── Load ─────────────────────────────────────────────────
+
+    def load(self) -> Optional[dict]:
+        """
+        Resolve the newest consistent state: {"turn", "seed", "rng", "router", "agents": [...]}
+        or None if there is no usable checkpoint.
+        """
+        files = self._files()
+        fulls = [f for f in files if f[0] == _KIND_FULL]
+        for _, full_seq, full_path in reversed(fulls):
+            try:
+                _, _, _, base = self._read(full_path)
+            except (OSError, ValueError) as e:
+                print(f"[Checkpoint] Skipping {full_path}: {e}")
+                continue
+
+            state = base
+            deltas = [f for f in files if f[0] == _KIND_DELTA and f[1] > full_seq]
+            for _, _, delta_path in reversed(deltas):
+                try:
+                    _, _, base_seq, delta = self._read(delta_path)
+                except (OSError, ValueError) as e:
+                    print(f"[Checkpoint] Skipping {delta_path}: {e}")
+                    continue
+                if base_seq != full_seq:
+                    continue
+                by_id = {a["identity"]["agent_id"]: a for a in base["agents"]}
+                by_id.update({a["identity"]["agent_id"]: a for a in delta["agents"]})
+                state = {**delta, "agents": [by_id[agent_id] for agent_id in delta["order"]]}
+                break
+
+            state["rng"] = _rng_state_from_json(state["rng"])
+            # Continue the delta chain on top of the loaded base
+            self._base_seq = full_seq
+            self._base_digests = {a["identity"]["agent_id"]: _digest(a) for a in base["agents"]}
+            self._since_full = state.get("since_full", 0)
+            return state
+        return None
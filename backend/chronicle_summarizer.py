@@ -10,13 +10,16 @@ N ターンごとに DB のイベントログを読み取り、
 import os
 import requests
 from database import SessionLocal
+from event_archive import query_events
 import models
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 CHRONICLE_INTERVAL = 100  # 100ターンごとに年代記を生成
 
 
-def _call_ollama(prompt: str) -> str:
+def _call_ollama(prompt: str, router=None) -> str:
+    if router is not None:
+        return router.complete(prompt, temperature=0.5, num_predict=200, timeout=90)
     try:
         resp = requests.post(
             f"{OLLAMA_BASE_URL}/api/generate",
@@ -35,9 +38,10 @@ def _call_ollama(prompt: str) -> str:
         return ""
 
 
-def generate_chronicle(current_turn: int) -> bool:
+def generate_chronicle(current_turn: int, router=None) -> bool:
     """
     Every CHRONICLE_INTERVAL turns, summarize recent events into a chronicle entry.
+    `router` is an optional LLMRouter backend (defaults to calling Ollama directly).
     Returns True if a chronicle was generated.
     """
     if current_turn % CHRONICLE_INTERVAL != 0 or current_turn == 0:
@@ -48,15 +52,7 @@ def generate_chronicle(current_turn: int) -> bool:
         since_turn = current_turn - CHRONICLE_INTERVAL
 
         # Gather REFLECTIONs and DAILY_ACTIONs from the period
-        events = (
-            db.query(models.SimulationEvent)
-            .filter(
-                models.SimulationEvent.turn >= since_turn,
-                models.SimulationEvent.turn < current_turn,
-            )
-            .order_by(models.SimulationEvent.turn.asc())
-            .all()
-        )
+        events = query_events(db, turn_start=since_turn, turn_end=current_turn)
 
         if not events:
             return False
@@ -77,7 +73,7 @@ def generate_chronicle(current_turn: int) -> bool:
             f"ancient-chronicle style. Focus on the most interesting cultural developments."
         )
 
-        summary = _call_ollama(prompt)
+        summary = _call_ollama(prompt, router)
         if not summary:
             return False
 
@@ -0,0 +1,292 @@
+"""
+Curated Art - エポックのアートワークのアップロードと派生画像の生成モジュール
+
+- Starlette は multipart の本文をハンドラより前に一時ファイルへスプールするので、上限は
+  UploadSizeLimit (ASGI) で受信した本文のバイト数を数えて掛け、超えた時点で 413 を返す
+  (Content-Length が大きすぎるものは本文を読む前に 413)。Content-Length が無くても同じ
+- ハンドラはチャンク単位で読み、書き込みはスレッドプールで行うので API のイベントループを塞がない
+- 保存する形式は Pillow で実際に開いて判定し、JPEG / PNG / WebP 以外 (SVG など) は拒否する。
+  拡張子はクライアントの content_type ではなく判定した形式から決める
+- 保存後、バックグラウンドのスレッドプールで Pillow により派生画像
+  (thumb: 320px JPEG / medium: 1280px JPEG / webp: 1280px WebP) を生成する
+- ファイル名は内容のハッシュ入り `{epoch_id}_{variant}_{digest}.{ext}` で、
+  original も含めて CuratedArtwork に1行ずつ記録する (variant はファイル名から読むのでスキーマ変更なし)。
+  内容が変われば URL も変わるので、curated_art 配下は長期キャッシュ (immutable) で配信できる
+"""
+import os
+import re
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+
+from database import SessionLocal
+import models
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ART_SUBDIR = "curated_art"
+ART_DIR = os.path.join(STATIC_DIR, ART_SUBDIR)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MULTIPART_OVERHEAD = 64 * 1024  # Boundaries and part headers around the file
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+ART_WORKERS = int(os.getenv("ART_WORKERS", "2"))
+ART_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# variant -> (longest side in px, Pillow format, extension)
+VARIANTS = {
+    "thumb": (320, "JPEG", "jpg"),
+    "medium": (1280, "JPEG", "jpg"),
+    "webp": (1280, "WEBP", "webp"),
+}
+# Pillow format -> extension of the stored original. Anything else is rejected.
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+_ARTWORK_NAME = re.compile(r"^(\d+)_([a-z]+)_([0-9a-f]{12})\.\w+$")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+class EpochNotFound(LookupError):
+    pass
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ART_WORKERS, thread_name_prefix="art")
+    return _executor
+
+
+def artwork_url(image_path: str) -> str:
+    return f"/static/{image_path}"
+
+
+def parse_artwork_name(image_path: str) -> Optional[tuple]:
+    """(epoch_id, variant, digest) for files written by this module, None for anything else."""
+    match = _ARTWORK_NAME.match(os.path.basename(image_path or ""))
+    if not match:
+        return None
+    return int(match.group(1)), match.group(2), match.group(3)
+
+
+def _epoch_exists(epoch_id: int) -> bool:
+    db = SessionLocal()
+    try:
+        return db.query(models.HistoricalEpoch.id).filter(models.HistoricalEpoch.id == epoch_id).first() is not None
+    finally:
+        db.close()
+
+
+def _record_artworks(epoch_id: int, names: List[str], raise_errors: bool = False):
+    db = SessionLocal()
+    try:
+        for name in names:
+            db.add(models.CuratedArtwork(epoch_id=epoch_id, image_path=f"{ART_SUBDIR}/{name}"))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"[Art] Failed to record artworks for epoch {epoch_id}: {e}")
+        if raise_errors:
+            raise
+    finally:
+        db.close()
+
+
+def detect_format(path: str) -> str:
+    """Extension for an uploaded file that Pillow verifies as JPEG/PNG/WebP. Raises UnsupportedImage."""
+    from PIL import Image
+
+    try:
+        with Image.open(path) as im:
+            fmt = im.format
+            im.verify()
+    except Exception:
+        raise UnsupportedImage("File is not a valid image")
+    if fmt not in ALLOWED_FORMATS:
+        raise UnsupportedImage(f"Unsupported image format {fmt}; use {', '.join(ALLOWED_FORMATS)}")
+    return ALLOWED_FORMATS[fmt]
+
+
+async def save_upload(epoch_id: int, upload) -> Dict[str, str]:
+    """
+    Stream an UploadFile to disk in chunks, enforcing MAX_UPLOAD_BYTES, then queue
+    the derivatives. Returns {"original": url}.
+    Raises EpochNotFound, UploadTooLarge or UnsupportedImage.
+    """
+    if not await run_in_threadpool(_epoch_exists, epoch_id):
+        raise EpochNotFound(f"Epoch {epoch_id} not found")
+    os.makedirs(ART_DIR, exist_ok=True)
+    tmp_path = os.path.join(ART_DIR, f".upload-{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    f = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge(f"File exceeds {MAX_UPLOAD_BYTES} bytes")
+            digest.update(chunk)
+            await run_in_threadpool(f.write, chunk)
+        await run_in_threadpool(f.close)
+    except BaseException:
+        f.close()
+        os.remove(tmp_path)
+        raise
+
+    try:
+        ext = await run_in_threadpool(detect_format, tmp_path)
+    except UnsupportedImage:
+        os.remove(tmp_path)
+        raise
+    short_digest = digest.hexdigest()[:12]
+    name = f"{epoch_id}_original_{short_digest}.{ext}"
+    path = os.path.join(ART_DIR, name)
+    existed = os.path.exists(path)  # Same content uploaded before: the file belongs to earlier rows too
+    os.replace(tmp_path, path)
+    try:
+        await run_in_threadpool(_record_artworks, epoch_id, [name], True)
+    except Exception:
+        if not existed:
+            os.remove(path)
+        raise
+
+    _get_executor().submit(generate_derivatives, epoch_id, path, short_digest)
+    print(f"[Art] Saved {size} bytes for epoch {epoch_id} ({name}); generating derivatives.")
+    return {"original": artwork_url(f"{ART_SUBDIR}/{name}")}
+
+
+def generate_derivatives(epoch_id: int, original_path: str, digest: str) -> List[str]:
+    """Write the VARIANTS of an uploaded image and record them. Runs in the art pool."""
+    from PIL import Image, ImageOps  # Only the art workers need Pillow
+
+    written = []
+    try:
+        largest = max(size for size, _, _ in VARIANTS.values())
+        with Image.open(original_path) as im:
+            im.draft("RGB", (largest, largest))  # JPEG: decode at a reduced scale when possible
+            source = ImageOps.exif_transpose(im)
+            if source.mode not in ("RGB", "RGBA"):
+                source = source.convert("RGBA" if "transparency" in source.info else "RGB")
+            # Largest variant first so the smaller ones are resized from an already reduced copy
+            for variant, (size, fmt, ext) in sorted(VARIANTS.items(), key=lambda v: -v[1][0]):
+                source = source.copy()
+                source.thumbnail((size, size), Image.Resampling.LANCZOS)
+                resized = source.convert("RGB") if fmt == "JPEG" and source.mode != "RGB" else source
+                name = f"{epoch_id}_{variant}_{digest}.{ext}"
+                tmp_path = os.path.join(ART_DIR, f".{name}.tmp")
+                resized.save(tmp_path, format=fmt, quality=82, optimize=True)
+                os.replace(tmp_path, os.path.join(ART_DIR, name))
+                written.append(name)
+    except Exception as e:
+        print(f"[Art] Could not generate derivatives for {os.path.basename(original_path)}: {e}")
+        return []
+
+    _record_artworks(epoch_id, written)
+    print(f"[Art] Derivatives ready for epoch {epoch_id}: {', '.join(written)}")
+    return written
+
+
+def epoch_images(db, epoch_ids: List[int]) -> Dict[int, Dict[str, str]]:
+    """
+    {epoch_id: {variant: url}} for the latest upload of each epoch, in one query.
+    Variants that are still being generated are simply missing.
+    """
+    if not epoch_ids:
+        return {}
+    artworks = (
+        db.query(models.CuratedArtwork)
+        .filter(models.CuratedArtwork.epoch_id.in_(epoch_ids))
+        .order_by(models.CuratedArtwork.id.asc())
+        .all()
+    )
+    latest_digest = {}
+    for art in artworks:
+        parsed = parse_artwork_name(art.image_path)
+        if parsed and parsed[1] == "original":
+            latest_digest[art.epoch_id] = parsed[2]
+
+    images = {}
+    for art in artworks:
+        parsed = parse_artwork_name(art.image_path)
+        if parsed and parsed[2] == latest_digest.get(art.epoch_id):
+            images.setdefault(art.epoch_id, {})[parsed[1]] = artwork_url(art.image_path)
+    return images
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets clients cache content-hashed artwork forever."""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if parse_artwork_name(str(full_path)):
+            response.headers["Cache-Control"] = ART_CACHE_CONTROL
+        return response
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware that caps upload bodies at MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD.
+    A Content-Length over the cap gets 413 before the body is read; otherwise the
+    received bytes are counted and the request is aborted with 413 once they exceed it
+    (chunked bodies included), before Starlette has spooled more than the cap.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not (scope["type"] == "http" and scope["method"] == "POST" and scope["path"].endswith("/upload")):
+            await self.app(scope, receive, send)
+            return
+
+        limit = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+        too_large = JSONResponse(status_code=413, content={"error": f"File exceeds {MAX_UPLOAD_BYTES} bytes"})
+        length = dict(scope["headers"]).get(b"content-length")
+        if length and length.isdigit() and int(length) > limit:
+            await too_large(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    # Aborts the multipart parser; the app's error response is replaced below
+                    raise HTTPException(status_code=413)
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if exceeded and not started:
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+        if exceeded and not started:
+            await too_large(scope, receive, send)
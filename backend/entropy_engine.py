@@ -0,0 +1,271 @@
+"""
+Entropy Engine - 記憶を少しずつ歪めて神話に育てる2段構えのエントロピーエンジン
+
+これまでは反省 (reflection) のたびに全エージェントが gemma2 を1回ずつ呼んで誇張していたため、
+人口に比例して重いモデルの呼び出しが増えていた。
+
+- 第1段 (ローカル): numpy でベクトル化した、シード付きのテキスト変異。
+  語彙表による誇張 ("wolf" -> "shadow beast")、数の水増し ("3" -> "40")、
+  固有名詞の格上げ ("Agent-2" -> "Mighty Agent-2") を、トークンごとに
+  entropy_level に比例した確率で適用する。entropy_level は反省のたびに
+  ENTROPY_DRIFT + 記憶の古さ + 変異の量だけ上がる
+- 第2段 (LLM): entropy_level が ENTROPY_ESCALATION_THRESHOLD を「跨いだ」記憶だけを集め、
+  LLMRouter.rewrite_batch で最大 ENTROPY_BATCH_SIZE 件ずつ1回のリクエストで神話に書き換える
+
+乱数はシミュレーションの random.Random から numpy の Generator を作るので、
+シード付きの実行とチェックポイントからの再開で同じ結果になる。
+"""
+import os
+import re
+import random
+from itertools import chain, repeat
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+ENTROPY_DRIFT = float(os.getenv("ENTROPY_DRIFT", "0.1"))              # Level gained per reflection
+ENTROPY_AGE_DRIFT = float(os.getenv("ENTROPY_AGE_DRIFT", "0.01"))     # Extra level per turn of memory age
+ENTROPY_MUTATION_RATE = float(os.getenv("ENTROPY_MUTATION_RATE", "0.5"))  # Token mutation probability per unit of level
+ENTROPY_MUTATION_GAIN = 0.2    # Level gained when every token of a memory mutated
+ENTROPY_MAX_TOKEN_P = 0.9
+ENTROPY_ESCALATION_THRESHOLD = float(os.getenv("ENTROPY_ESCALATION_THRESHOLD", "0.5"))
+ENTROPY_BATCH_SIZE = int(os.getenv("ENTROPY_BATCH_SIZE", "16"))       # Memories per batched LLM rewrite
+ENTROPY_TIERED = os.getenv("ENTROPY_TIERED", "1") == "1"              # 0 = one gemma2 reflection per agent
+MAX_VOCAB = 200_000
+
+# Lower-case word -> exaggerated replacements. A replacement never contains its own key,
+# so a retold memory escalates ("storm" -> "wrath of the sky" -> "wrath of the heavens")
+# instead of stacking adjectives.
+EXAGGERATIONS = {
+    "big": ["giant", "colossal", "mountain-sized"],
+    "large": ["enormous", "giant"],
+    "small": ["tiny", "hidden"],
+    "old": ["ancient", "ageless"],
+    "strange": ["otherworldly", "forbidden"],
+    "good": ["blessed", "holy"],
+    "bad": ["cursed", "wicked"],
+    "tired": ["exhausted", "half-dead"],
+    "wolf": ["shadow beast", "wolf-god"],
+    "beast": ["monster", "demon"],
+    "fish": ["silver spirits", "river children"],
+    "river": ["sacred waters", "great serpent of water"],
+    "fire": ["eternal flame", "sky-fire"],
+    "water": ["holy springs"],
+    "sun": ["sun-god"],
+    "moon": ["moon-spirit"],
+    "star": ["watching light"],
+    "stars": ["eternal lights", "watchers above"],
+    "sky": ["heavens"],
+    "night": ["endless dark"],
+    "rain": ["great flood"],
+    "storm": ["wrath of the sky"],
+    "tree": ["world-tree"],
+    "forest": ["whispering woods", "endless woods"],
+    "hills": ["sacred peaks"],
+    "cave": ["cavern of echoes", "forbidden cavern"],
+    "stone": ["sacred monolith"],
+    "tool": ["blessed relic"],
+    "berries": ["golden fruit"],
+    "elder": ["patriarch", "eldest sage"],
+    "children": ["chosen ones"],
+    "neighbors": ["kin"],
+    "dream": ["vision", "prophecy"],
+    "saw": ["beheld", "witnessed"],
+    "found": ["was gifted"],
+    "walked": ["wandered for days"],
+    "talked": ["communed"],
+    "hunting": ["the great hunt"],
+    # Number words are inflated like digits
+    "one": ["three"],
+    "two": ["seven"],
+    "three": ["twelve"],
+    "few": ["hundreds of"],
+    "some": ["countless"],
+    "many": ["countless"],
+}
+TITLES = ["Mighty", "Holy", "the Great", "Ancient"]
+_TITLE_WORDS = {"Mighty", "Holy", "Great", "Ancient"}
+
+_TOKEN_RE = re.compile(r"^(\W*)(.*?)(\W*)$", re.S)
+_SENTENCE_END = (".", "!", "?", ":", "]")  # "]" ends the "[LEGEND]" tag
+_NOT_ENTITIES = {"I", "A", "An", "The", "We", "They", "He", "She", "It", "Then", "And", "But"}
+
+
+class EntropyEngine:
+    """
+    Local, vectorized tier. Token features are cached in a vocabulary so a batch only
+    pays Python-level work for splitting, unseen tokens and the tokens that mutate.
+    """
+
+    def __init__(
+        self,
+        drift: float = ENTROPY_DRIFT,
+        age_drift: float = ENTROPY_AGE_DRIFT,
+        mutation_rate: float = ENTROPY_MUTATION_RATE,
+        threshold: float = ENTROPY_ESCALATION_THRESHOLD,
+    ):
+        self.drift = drift
+        self.age_drift = age_drift
+        self.mutation_rate = mutation_rate
+        self.threshold = threshold
+
+        self._options = list(EXAGGERATIONS.values())
+        self._lex_index = {word: i for i, word in enumerate(EXAGGERATIONS)}
+        self._option_counts = np.array([len(o) for o in self._options], dtype=np.int64)
+        self._reset_vocab()
+
+    def _reset_vocab(self):
+        self._vocab = {}
+        self._parts = []      # (leading punctuation, core, trailing punctuation)
+        self._lex = []        # index into EXAGGERATIONS or -1
+        self._num = []        # numeric value or nan
+        self._cap = []        # capitalized entity candidate
+        self._title = []      # one of TITLES (an entity is only titled once)
+        self._end = []        # ends a sentence
+        self._arrays = None
+
+    def _add_token(self, token: str) -> int:
+        lead, core, trail = _TOKEN_RE.match(token).groups()
+        # Every feature is computed before the vocabulary is touched so the lists stay aligned.
+        # Only ASCII digits are numbers: str.isdigit() also accepts "②" or "³", which float() rejects.
+        lex = self._lex_index.get(core.lower(), -1)
+        num = float(core) if core.isascii() and core.isdigit() else np.nan
+        is_title = core in _TITLE_WORDS
+        cap = lex < 0 and core[:1].isupper() and core not in _NOT_ENTITIES and not is_title
+        end = trail.endswith(_SENTENCE_END)
+
+        index = len(self._parts)
+        self._parts.append((lead, core, trail))
+        self._lex.append(lex)
+        self._num.append(num)
+        self._cap.append(cap)
+        self._title.append(is_title)
+        self._end.append(end)
+        self._vocab[token] = index
+        self._arrays = None
+        return index
+
+    def _feature_arrays(self):
+        if self._arrays is None:
+            self._arrays = (
+                np.array(self._lex, dtype=np.int64),
+                np.array(self._num, dtype=np.float64),
+                np.array(self._cap, dtype=bool),
+                np.array(self._title, dtype=bool),
+                np.array(self._end, dtype=bool),
+            )
+        return self._arrays
+
+    def mutate(
+        self,
+        texts: Sequence[str],
+        levels: np.ndarray,
+        ages: np.ndarray,
+        gen: np.random.Generator,
+    ) -> Tuple[List[str], np.ndarray]:
+        """
+        Mutate a batch of texts. Returns (new texts, new entropy levels).
+        The chance of mutating each token is proportional to the memory's drifted level.
+        """
+        n = len(texts)
+        if n == 0:
+            return [], np.zeros(0)
+        if len(self._vocab) > MAX_VOCAB:
+            self._reset_vocab()
+
+        tokens = [t.split() for t in texts]
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=n)
+        flat = list(chain.from_iterable(tokens))
+        total = len(flat)
+
+        ids = np.fromiter(map(self._vocab.get, flat, repeat(-1, total)), dtype=np.int64, count=total)
+        for i in np.flatnonzero(ids < 0):
+            token = flat[i]  # May have been added earlier in this batch
+            ids[i] = self._vocab[token] if token in self._vocab else self._add_token(token)
+        lex, num, cap, title, end = self._feature_arrays()
+
+        drifted = np.minimum(np.asarray(levels, dtype=np.float64) + self.drift + self.age_drift * ages, 1.0)
+        if total == 0:
+            return list(texts), drifted
+
+        owner = np.repeat(np.arange(n), lengths)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        sentence_start = np.empty(total, dtype=bool)
+        sentence_start[0] = True
+        sentence_start[1:] = end[ids[:-1]]
+        sentence_start[starts[lengths > 0]] = True
+        after_title = np.zeros(total, dtype=bool)
+        after_title[1:] = title[ids[:-1]]
+
+        p = np.minimum(self.mutation_rate * drifted[owner], ENTROPY_MAX_TOKEN_P)
+        hit = gen.random(total) < p
+        picks = gen.integers(0, 1 << 30, size=total)
+        scale = gen.exponential(1.0, size=total)
+
+        token_lex = lex[ids]
+        exaggerate = hit & (token_lex >= 0)
+        inflate = hit & ~np.isnan(num[ids])
+        entitle = hit & cap[ids] & ~sentence_start & ~after_title
+
+        out = flat  # Rewritten in place; only mutated tokens are touched
+        for i in np.flatnonzero(exaggerate):
+            lead, core, trail = self._parts[ids[i]]
+            choice = self._options[token_lex[i]][picks[i] % self._option_counts[token_lex[i]]]
+            if core[:1].isupper():
+                choice = choice[:1].upper() + choice[1:]
+            out[i] = f"{lead}{choice}{trail}"
+        for i in np.flatnonzero(inflate):
+            lead, core, trail = self._parts[ids[i]]
+            value = num[ids[i]]
+            inflated = int(np.ceil(value * (2 + 10 * drifted[owner[i]] * scale[i]))) + 1
+            out[i] = f"{lead}{inflated}{trail}"
+        for i in np.flatnonzero(entitle):
+            out[i] = f"{TITLES[picks[i] % len(TITLES)]} {out[i]}"
+
+        changed = np.bincount(owner[exaggerate | inflate | entitle], minlength=n)
+        new_levels = np.minimum(drifted + ENTROPY_MUTATION_GAIN * changed / np.maximum(lengths, 1), 1.0)
+        ends = starts + lengths
+        new_texts = [" ".join(out[a:b]) for a, b in zip(starts, ends)]
+        return new_texts, new_levels
+
+    def apply(self, items: list, current_time: int, rng: random.Random) -> list:
+        """
+        Mutate MemoryItems in place (content and entropy_level).
+        Returns the items whose level crossed the escalation threshold in this pass.
+        """
+        if not items:
+            return []
+        gen = np.random.default_rng(rng.getrandbits(64))
+        levels = np.fromiter((m.entropy_level for m in items), dtype=np.float64, count=len(items))
+        ages = np.fromiter((max(0, current_time - m.timestamp) for m in items), dtype=np.float64, count=len(items))
+        texts, new_levels = self.mutate([m.content for m in items], levels, ages, gen)
+        crossed = (levels < self.threshold) & (new_levels >= self.threshold)
+        for m, text, level in zip(items, texts, new_levels):
+            m.content = text
+            m.entropy_level = float(level)
+        return [m for m, c in zip(items, crossed) if c]
+
+
+_default_engine = None
+
+
+def default_engine() -> EntropyEngine:
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = EntropyEngine()
+    return _default_engine
+
+
+if __name__ == "__main__":
+    # Quick self-check: python entropy_engine.py
+    from memory import MemoryItem
+
+    engine = EntropyEngine(drift=1.0)
+    check_rng = random.Random(0)
+    for round_texts in (["I saw ② wolves near the ³ rivers", "We found 3 berries"], ["Agent-2 saw the big wolf."]):
+        items = [MemoryItem(content=t, importance=0.5, timestamp=0) for t in round_texts]
+        engine.apply(items, current_time=10, rng=check_rng)
+        for before, item in zip(round_texts, items):
+            print(f"{before!r} -> {item.content!r} (entropy {item.entropy_level:.2f})")
+    assert len({len(engine._parts), len(engine._lex), len(engine._num), len(engine._vocab)}) == 1
+    print("[Entropy] Self-check passed.")
@@ -8,14 +8,18 @@ Epoch Detector - 文明の節目（エポック）を自動検出するモジュ
 import os
 import requests
 from database import SessionLocal
+from event_archive import query_events
+from analytics import count_events
 import models
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 EPOCH_CHECK_INTERVAL = 50  # N ターンごとにエポック検出を実行
 
 
-def _call_ollama(prompt: str) -> str:
-    """Call Ollama for epoch analysis."""
+def _call_ollama(prompt: str, router=None) -> str:
+    """Call Ollama for epoch analysis (through the simulation's LLM backend if given)."""
+    if router is not None:
+        return router.complete(prompt, temperature=0.3, num_predict=80, timeout=60)
     try:
         resp = requests.post(
             f"{OLLAMA_BASE_URL}/api/generate",
@@ -34,9 +38,10 @@ def _call_ollama(prompt: str) -> str:
         return ""
 
 
-def detect_and_record_epoch(current_turn: int) -> bool:
+def detect_and_record_epoch(current_turn: int, router=None) -> bool:
     """
     Checks if a new epoch should be recorded at the given turn.
+    `router` is an optional LLMRouter backend (defaults to calling Ollama directly).
     Returns True if a new epoch was created.
     """
     if current_turn % EPOCH_CHECK_INTERVAL != 0 or current_turn == 0:
@@ -46,15 +51,13 @@ def detect_and_record_epoch(current_turn: int) -> bool:
     try:
         # Gather recent REFLECTIONs from the last EPOCH_CHECK_INTERVAL turns
         since_turn = current_turn - EPOCH_CHECK_INTERVAL
-        reflections = (
-            db.query(models.SimulationEvent)
-            .filter(
-                models.SimulationEvent.event_type == "REFLECTION",
-                models.SimulationEvent.turn >= since_turn,
-                models.SimulationEvent.turn < current_turn,
-            )
-            .order_by(models.SimulationEvent.turn.asc())
-            .all()
+
+        # Cheap check against the rollups before loading any event rows
+        if count_events(db, since_turn, current_turn, event_type="REFLECTION") == 0:
+            return False
+
+        reflections = query_events(
+            db, turn_start=since_turn, turn_end=current_turn, event_types=["REFLECTION"]
         )
 
         if not reflections:
@@ -83,7 +86,7 @@ def detect_and_record_epoch(current_turn: int) -> bool:
             "Just output the era name, nothing else.\n\n"
             f"Reflections:\n{reflection_texts}\n\nEra Name:"
         )
-        era_name = _call_ollama(name_prompt)
+        era_name = _call_ollama(name_prompt, router)
         if not era_name:
             era_name = f"The Era of Turn {since_turn}"
         era_name = era_name.strip().strip('"\'').split("\n")[0][:100]
@@ -97,7 +100,7 @@ def detect_and_record_epoch(current_turn: int) -> bool:
             "[Atmosphere/Lighting], [Art Style], --ar 16:9 --v 6.0. "
             "Output ONLY the prompt text."
         )
-        master_prompt = _call_ollama(art_prompt)
+        master_prompt = _call_ollama(art_prompt, router)
         if not master_prompt:
             master_prompt = f"A cinematic representation of the {era_name} era, ancient civilization style, hyper-realistic --ar 16:9"
 
@@ -0,0 +1,438 @@
+"""
+Event Archive - simulation_events のターン範囲パーティション & コールドアーカイブ
+
+simulation_events は全エージェントの全行動を永久に保持するため、
+長期観測 (数百万ターン) では hot テーブルと VACUUM コストが際限なく増え続ける。
+
+- PostgreSQL では simulation_events を RANGE (turn) でネイティブパーティション化する
+- 古いパーティションは列指向の gzip JSON ファイルとしてローカルディスクに退避し、
+  DETACH + DROP して hot テーブルのサイズを一定に保つ
+- query_events / latest_events は hot テーブルとアーカイブを透過的にマージして返す
+  (年代記・エポック検出・/api/history はここ経由で読む)
+
+SQLite など PostgreSQL 以外の DB ではパーティション関連の処理はすべて no-op となり、
+読み出しは通常のテーブルクエリと同じ結果を返す。
+
+既存の (非パーティション) テーブルは `python event_archive.py migrate` で移行する。
+"""
+import os
+import re
+import gzip
+import json
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Iterable
+from pydantic import BaseModel
+from sqlalchemy import text
+from database import SessionLocal, get_engine
+from search_index import index_archived_partition
+import models
+
+PARTITION_TURN_SPAN = int(os.getenv("EVENT_PARTITION_SPAN", "1000"))  # 1パーティションあたりのターン数
+HOT_PARTITIONS = int(os.getenv("EVENT_HOT_PARTITIONS", "3"))  # 現在のパーティションを含めて hot に残す数
+ARCHIVE_CHECK_INTERVAL = 100  # N ターンごとにアーカイブ対象をチェック
+ARCHIVE_DIR = os.getenv(
+    "EVENT_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "archived_events")
+)
+_MANIFEST_PATH = os.path.join(ARCHIVE_DIR, "manifest.json")
+
+_TABLE = models.SimulationEvent.__tablename__
+_COLUMNS = ["id", "turn", "agent_id", "event_type", "content", "vector_hash", "created_at"]
+_BOUND_RE = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+# Process-local caches so the per-turn hot path never issues DDL after the first hit
+_partitioned: Optional[bool] = None
+_known_partitions: set = set()
+
+
+class ArchivedEvent(BaseModel):
+    """Read-only stand-in for a SimulationEvent row served from a cold archive file."""
+    id: int
+    turn: int
+    agent_id: Optional[str] = None
+    event_type: Optional[str] = None
+    content: Optional[str] = None
+    vector_hash: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+
+def _is_postgres() -> bool:
+    return get_engine().dialect.name == "postgresql"
+
+
+def _partition_start(turn: int) -> int:
+    return (turn // PARTITION_TURN_SPAN) * PARTITION_TURN_SPAN
+
+
+def _partition_name(start: int) -> str:
+    return f"{_TABLE}_p{start}"
+
+
+def _relkind(conn, relname: str) -> Optional[str]:
+    row = conn.execute(
+        text(
+            "SELECT c.relkind FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = :name AND n.nspname = current_schema()"
+        ),
+        {"name": relname},
+    ).first()
+    return row[0] if row else None
+
+
+def _create_partitioned_parent(conn):
+    conn.execute(text(
+        f"CREATE TABLE {_TABLE} ("
+        "id SERIAL NOT NULL, "
+        "turn INTEGER NOT NULL, "
+        "agent_id VARCHAR, "
+        "event_type VARCHAR, "
+        "content TEXT, "
+        "vector_hash VARCHAR, "
+        "created_at TIMESTAMP WITH TIME ZONE DEFAULT now(), "
+        "PRIMARY KEY (id, turn)"
+        ") PARTITION BY RANGE (turn)"
+    ))
+    # Same index names as models.SimulationEvent so create_all stays a no-op
+    for col in ("id", "turn", "agent_id"):
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{_TABLE}_{col} ON {_TABLE} ({col})"))
+
+
+def is_partitioned() -> bool:
+    """True if simulation_events is a native Postgres partitioned table."""
+    global _partitioned
+    if _partitioned is None:
+        if not _is_postgres():
+            _partitioned = False
+        else:
+            with get_engine().connect() as conn:
+                _partitioned = _relkind(conn, _TABLE) == "p"
+    return _partitioned
+
+
+def prepare_events_table():
+    """
+    Create simulation_events as a turn-range partitioned table on a fresh Postgres DB.
+    Must run before Base.metadata.create_all so the ORM does not create a plain table.
+    """
+    global _partitioned
+    if not _is_postgres():
+        return
+    try:
+        with get_engine().begin() as conn:
+            kind = _relkind(conn, _TABLE)
+            if kind is None:
+                _create_partitioned_parent(conn)
+                print(f"[EventArchive] Created partitioned table '{_TABLE}' (span={PARTITION_TURN_SPAN} turns).")
+            elif kind == "r":
+                print(f"[EventArchive] '{_TABLE}' is not partitioned. Run `python event_archive.py migrate` to convert it.")
+        _partitioned = None
+    except Exception as e:
+        print(f"[EventArchive] Could not prepare events table: {e}")
+
+
+def ensure_partition_for_turn(turn: int):
+    """Make sure the partition holding `turn` (and the next one) exists before inserts."""
+    if not is_partitioned():
+        return
+    start = _partition_start(turn)
+    for s in (start, start + PARTITION_TURN_SPAN):
+        if s in _known_partitions:
+            continue
+        name = _partition_name(s)
+        try:
+            with get_engine().begin() as conn:
+                if _relkind(conn, name) is None:
+                    conn.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {_TABLE} "
+                        f"FOR VALUES FROM ({s}) TO ({s + PARTITION_TURN_SPAN})"
+                    ))
+                    print(f"[EventArchive] Created partition {name}.")
+            _known_partitions.add(s)
+        except Exception as e:
+            print(f"[EventArchive] Could not create partition {name}: {e}")
+
+
+def _list_partitions(conn) -> List[tuple]:
+    """Return [(name, turn_start, turn_end)] for every attached partition, oldest first."""
+    rows = conn.execute(
+        text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :parent"
+        ),
+        {"parent": _TABLE},
+    ).all()
+    partitions = []
+    for name, bound in rows:
+        m = _BOUND_RE.search(bound or "")
+        if m:
+            partitions.append((name, int(m.group(1)), int(m.group(2))))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+# ─── Cold storage files ───────────────────────────────────────────
+
+def _atomic_write(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_manifest() -> List[dict]:
+    try:
+        mtime = os.path.getmtime(_MANIFEST_PATH)
+    except OSError:
+        return []
+    return _read_manifest(mtime)
+
+
+@lru_cache(maxsize=1)
+def _read_manifest(mtime: float) -> List[dict]:
+    with open(_MANIFEST_PATH, "r", encoding="utf-8") as f:
+        return json.load(f).get("segments", [])
+
+
+def _write_segment(turn_start: int, turn_end: int, rows: List[tuple]) -> dict:
+    """Write rows as a column-oriented gzip JSON file and register it in the manifest."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    columns = {col: [] for col in _COLUMNS}
+    for row in rows:
+        for col, value in zip(_COLUMNS, row):
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            columns[col].append(value)
+
+    filename = f"events_{turn_start:010d}_{turn_end:010d}.json.gz"
+    payload = {"turn_start": turn_start, "turn_end": turn_end, "rows": len(rows), "columns": columns}
+    _atomic_write(
+        os.path.join(ARCHIVE_DIR, filename),
+        gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9),
+    )
+
+    segment = {"turn_start": turn_start, "turn_end": turn_end, "rows": len(rows), "file": filename}
+    segments = [s for s in _load_manifest() if s["file"] != filename] + [segment]
+    segments.sort(key=lambda s: s["turn_start"])
+    _atomic_write(_MANIFEST_PATH, json.dumps({"segments": segments}, indent=2).encode("utf-8"))
+    return segment
+
+
+@lru_cache(maxsize=4)
+def _read_segment(filename: str) -> List[ArchivedEvent]:
+    with gzip.open(os.path.join(ARCHIVE_DIR, filename), "rt", encoding="utf-8") as f:
+        columns = json.load(f)["columns"]
+    return [
+        ArchivedEvent(**dict(zip(_COLUMNS, values)))
+        for values in zip(*(columns[col] for col in _COLUMNS))
+    ]
+
+
+def archived_turn_end() -> int:
+    """Exclusive upper turn bound of the archived history (0 if nothing is archived)."""
+    segments = _load_manifest()
+    return max((s["turn_end"] for s in segments), default=0)
+
+
+def _archived_range(turn_start: int, turn_end: int) -> bool:
+    return any(s["turn_start"] == turn_start and s["turn_end"] == turn_end for s in _load_manifest())
+
+
+def load_archived_events(
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    event_types: Optional[Iterable[str]] = None,
+    agent_id: Optional[str] = None,
+) -> List[ArchivedEvent]:
+    """Read archived events in [turn_start, turn_end), ordered by (turn, id)."""
+    types = set(event_types) if event_types else None
+    result = []
+    for seg in _load_manifest():
+        if turn_start is not None and seg["turn_end"] <= turn_start:
+            continue
+        if turn_end is not None and seg["turn_start"] >= turn_end:
+            continue
+        for ev in _read_segment(seg["file"]):
+            if turn_start is not None and ev.turn < turn_start:
+                continue
+            if turn_end is not None and ev.turn >= turn_end:
+                continue
+            if types is not None and ev.event_type not in types:
+                continue
+            if agent_id is not None and ev.agent_id != agent_id:
+                continue
+            result.append(ev)
+    result.sort(key=lambda ev: (ev.turn, ev.id))
+    return result
+
+
+# ─── Archival job ─────────────────────────────────────────────────
+
+def archive_cold_partitions(current_turn: int, force: bool = False) -> int:
+    """
+    Every ARCHIVE_CHECK_INTERVAL turns, move partitions older than the newest
+    HOT_PARTITIONS into cold storage. Returns the number of partitions archived.
+    """
+    if not force and (current_turn % ARCHIVE_CHECK_INTERVAL != 0 or current_turn == 0):
+        return 0
+    if not is_partitioned():
+        return 0
+
+    cutoff = _partition_start(current_turn) - (HOT_PARTITIONS - 1) * PARTITION_TURN_SPAN
+    archived = 0
+    try:
+        with get_engine().connect() as conn:
+            cold = [p for p in _list_partitions(conn) if p[2] <= cutoff]
+
+        for name, turn_start, turn_end in cold:
+            with get_engine().begin() as conn:
+                if _archived_range(turn_start, turn_end):
+                    # A previous run wrote the segment but failed before the drop
+                    detail = "segment already written"
+                else:
+                    rows = conn.execute(
+                        text(f"SELECT {', '.join(_COLUMNS)} FROM {name} ORDER BY turn, id")
+                    ).all()
+                    # The file must be durable before the partition is dropped
+                    _write_segment(turn_start, turn_end, [tuple(r) for r in rows])
+                    detail = f"{len(rows)} events"
+                index_archived_partition(conn, name)  # Only with SEARCH_ARCHIVE_TURNS
+                conn.execute(text(f"ALTER TABLE {_TABLE} DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            _known_partitions.discard(turn_start)
+            archived += 1
+            print(f"[EventArchive] Archived {name} ({detail}, turns {turn_start}-{turn_end}).")
+    except Exception as e:
+        print(f"[EventArchive] Archival failed: {e}")
+    return archived
+
+
+# ─── Read path ────────────────────────────────────────────────────
+
+def hot_events_query(db, archive_end: Optional[int] = None):
+    """
+    Query on the hot table that skips turns already covered by the archive, so a
+    partition whose segment was written but not yet dropped is not counted twice.
+    """
+    if archive_end is None:
+        archive_end = archived_turn_end()
+    q = db.query(models.SimulationEvent)
+    if archive_end > 0:
+        q = q.filter(models.SimulationEvent.turn >= archive_end)
+    return q
+
+
+def query_events(
+    db,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    event_types: Optional[Iterable[str]] = None,
+    agent_id: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> list:
+    """
+    Return events in [turn_start, turn_end) ordered by (turn, id), transparently
+    merging archived segments with the hot table.
+    """
+    event_types = list(event_types) if event_types else None
+
+    events = []
+    archive_end = archived_turn_end()
+    if turn_start is None or turn_start < archive_end:
+        events.extend(load_archived_events(turn_start, turn_end, event_types, agent_id))
+
+    q = hot_events_query(db, archive_end)
+    if turn_start is not None:
+        q = q.filter(models.SimulationEvent.turn >= turn_start)
+    if turn_end is not None:
+        q = q.filter(models.SimulationEvent.turn < turn_end)
+    if event_types:
+        q = q.filter(models.SimulationEvent.event_type.in_(event_types))
+    if agent_id is not None:
+        q = q.filter(models.SimulationEvent.agent_id == agent_id)
+    q = q.order_by(models.SimulationEvent.turn.asc(), models.SimulationEvent.id.asc())
+    if limit is not None and len(events) < limit:
+        q = q.limit(limit - len(events))
+    if limit is None or len(events) < limit:
+        events.extend(q.all())
+
+    return events[:limit] if limit is not None else events
+
+
+def latest_events(db, limit: int) -> list:
+    """Return the newest `limit` events (newest first), topping up from the archive if the hot table is short."""
+    events = (
+        hot_events_query(db)
+        .order_by(models.SimulationEvent.id.desc())
+        .limit(limit)
+        .all()
+    )
+    for seg in reversed(_load_manifest()):
+        if len(events) >= limit:
+            break
+        older = sorted(_read_segment(seg["file"]), key=lambda ev: ev.id, reverse=True)
+        events.extend(older[: limit - len(events)])
+    return events
+
+
+# ─── Migration ────────────────────────────────────────────────────
+
+def migrate_legacy_table():
+    """Convert an existing plain simulation_events table into a partitioned one (one transaction)."""
+    global _partitioned
+    if not _is_postgres():
+        print("[EventArchive] Partitioning requires PostgreSQL. Nothing to do.")
+        return
+    legacy = f"{_TABLE}_legacy"
+    with get_engine().begin() as conn:
+        if _relkind(conn, _TABLE) != "r":
+            print(f"[EventArchive] '{_TABLE}' is already partitioned or missing. Nothing to do.")
+            return
+
+        conn.execute(text(f"ALTER TABLE {_TABLE} RENAME TO {legacy}"))
+        conn.execute(text(f"ALTER INDEX IF EXISTS {_TABLE}_pkey RENAME TO {legacy}_pkey"))
+        for col in ("id", "turn", "agent_id"):
+            conn.execute(text(f"ALTER INDEX IF EXISTS ix_{_TABLE}_{col} RENAME TO ix_{legacy}_{col}"))
+
+        _create_partitioned_parent(conn)
+        lo, hi = conn.execute(text(f"SELECT COALESCE(MIN(turn), 0), COALESCE(MAX(turn), 0) FROM {legacy}")).one()
+        for s in range(_partition_start(lo), _partition_start(hi) + 2 * PARTITION_TURN_SPAN, PARTITION_TURN_SPAN):
+            conn.execute(text(
+                f"CREATE TABLE {_partition_name(s)} PARTITION OF {_TABLE} "
+                f"FOR VALUES FROM ({s}) TO ({s + PARTITION_TURN_SPAN})"
+            ))
+
+        cols = ", ".join(_COLUMNS)
+        select_cols = ", ".join("COALESCE(turn, 0)" if c == "turn" else c for c in _COLUMNS)
+        conn.execute(text(f"INSERT INTO {_TABLE} ({cols}) SELECT {select_cols} FROM {legacy}"))
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{_TABLE}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {_TABLE}), 0) + 1, false)"
+        ))
+        conn.execute(text(f"DROP TABLE {legacy}"))
+    _partitioned = None
+    _known_partitions.clear()
+    print(f"[EventArchive] Migrated '{_TABLE}' to turn-range partitions.")
+
+
+if __name__ == "__main__":
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "archive"
+    if command == "migrate":
+        migrate_legacy_table()
+    elif command == "archive":
+        db = SessionLocal()
+        try:
+            last = db.query(models.SimulationEvent).order_by(models.SimulationEvent.turn.desc()).first()
+        finally:
+            db.close()
+        count = archive_cold_partitions(int(last.turn) if last else 0, force=True)
+        print(f"[EventArchive] {count} partition(s) archived.")
+    else:
+        print("Usage: python event_archive.py [migrate|archive]")
+        sys.exit(1)
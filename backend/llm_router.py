@@ -1,11 +1,36 @@
 import random
 import os
+import json
+import hashlib
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
 import requests
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # Keep models loaded between turns
+_NUMBERED_LINE = re.compile(r"^\s*(\d+)[.):]\s*(.+?)\s*$", re.M)
+
+
+def _parse_numbered(text: str, count: int) -> List[str]:
+    """Split a "1. ...\\n2. ..." answer into `count` items ("" for missing ones)."""
+    items = [""] * count
+    for number, content in _NUMBERED_LINE.findall(text):
+        index = int(number) - 1
+        if 0 <= index < count and not items[index]:
+            items[index] = content
+    if count == 1 and not items[0]:
+        items[0] = text.strip()
+    return items
 
 class LLMRouter:
-    def __init__(self):
+    def __init__(self, rng: Optional[random.Random] = None):
+        # Seeded runs pass their own RNG so entropy rolls and Ollama sampling are reproducible
+        self.seeded = rng is not None
+        self.rng = rng or random.Random()
+        self.call_count = 0
         # Lightweight model for daily chatter
         self.fast_model = "llama3.2:latest"
         # Stronger model for reflection & myth-creation
@@ -13,8 +38,34 @@ class LLMRouter:
         # Embedding model for vector extraction
         self.embed_model = "mxbai-embed-large:latest"
 
-    def _call_ollama(self, model: str, prompt: str, temperature: float = 0.7) -> str:
+    def use_rng(self, rng: random.Random):
+        """Share the simulation's seeded RNG (also seeds Ollama sampling per call)."""
+        self.rng = rng
+        self.seeded = True
+
+    def get_state(self) -> Optional[dict]:
+        """Backend state that must survive a checkpoint/resume (None if there is none)."""
+        return None
+
+    def set_state(self, state: Optional[dict]):
+        pass
+
+    def _generate(self, model: str, prompt: str, temperature: float = 0.7,
+                  num_predict: int = 120, timeout: int = 60) -> str:
+        self.call_count += 1
+        # Drawn for every backend so the RNG stream is identical across ollama/replay/stub
+        seed = self.rng.randrange(2**31) if self.seeded else None
+        return self._call_ollama(model, prompt, temperature, num_predict, timeout, seed)
+
+    def _call_ollama(self, model: str, prompt: str, temperature: float = 0.7,
+                     num_predict: int = 120, timeout: int = 60, seed: Optional[int] = None) -> str:
         """Send a prompt to the local Ollama API and return the response text."""
+        options = {
+            "temperature": temperature,
+            "num_predict": num_predict,  # Keep responses concise
+        }
+        if seed is not None:
+            options["seed"] = seed
         try:
             resp = requests.post(
                 f"{OLLAMA_BASE_URL}/api/generate",
@@ -22,12 +73,10 @@ class LLMRouter:
                     "model": model,
                     "prompt": prompt,
                     "stream": False,
-                    "options": {
-                        "temperature": temperature,
-                        "num_predict": 120,  # Keep responses concise
-                    }
+                    "keep_alive": OLLAMA_KEEP_ALIVE,
+                    "options": options,
                 },
-                timeout=60
+                timeout=timeout
             )
             resp.raise_for_status()
             return resp.json().get("response", "").strip()
@@ -47,7 +96,7 @@ class LLMRouter:
             "observe nature, tell stories, etc. Do NOT always say the same thing."
         )
         full_prompt = f"{system_prompt}\n\nScenario: {prompt}\nYour action:"
-        result = self._call_ollama(self.fast_model, full_prompt, temperature=0.9)
+        result = self._generate(self.fast_model, full_prompt, temperature=0.9)
         return result
 
     def reflect_and_hallucinate(self, memories: list, entropy_factor: float) -> str:
@@ -66,7 +115,7 @@ class LLMRouter:
 
         memory_summary = "; ".join(memory_texts[-5:]) if memory_texts else "Nothing notable happened."
 
-        if random.random() < entropy_factor:
+        if self.rng.random() < entropy_factor:
             # HALLUCINATION MODE: Exaggerate and mythologize
             system_prompt = (
                 "You are the collective unconscious memory of an ancient village. "
@@ -82,9 +131,42 @@ class LLMRouter:
             )
 
         full_prompt = f"{system_prompt}\n\nToday's events: {memory_summary}\nYour reflection:"
-        result = self._call_ollama(self.smart_model, full_prompt, temperature=1.1)
+        result = self._generate(self.smart_model, full_prompt, temperature=1.1)
         return result
 
+    def rewrite_batch(self, memories: List[str], batch_size: int = 16) -> List[str]:
+        """
+        Turn many distorted memories into legends with one smart-model call per batch
+        instead of one per agent. Returns one legend per memory ("" where the model failed).
+        """
+        system_prompt = (
+            "You are the collective unconscious memory of an ancient village. "
+            "Each numbered line is a memory that has been retold until it became half-myth. "
+            "Rewrite every memory as a dramatic legend of 1-2 sentences. "
+            "Exaggerate wildly. Introduce gods, spirits, or supernatural forces. "
+            "Answer with the same numbering, one legend per line, and nothing else."
+        )
+        legends = []
+        for start in range(0, len(memories), batch_size):
+            chunk = memories[start:start + batch_size]
+            numbered = "\n".join(f"{i}. {' '.join(m.split())}" for i, m in enumerate(chunk, 1))
+            full_prompt = f"{system_prompt}\n\nMemories:\n{numbered}\n\nLegends:"
+            result = self._generate(self.smart_model, full_prompt, temperature=1.1,
+                                    num_predict=80 * len(chunk), timeout=60 + 15 * len(chunk))
+            if result.startswith("[FALLBACK]"):
+                legends += [""] * len(chunk)
+            else:
+                legends += _parse_numbered(result, len(chunk))
+        return legends
+
+    def complete(self, prompt: str, temperature: float = 0.5, num_predict: int = 120, timeout: int = 60) -> str:
+        """
+        Free-form smart-model call for turn-level phases (epoch naming, chronicles).
+        Returns "" on failure, like the module-level helpers it replaces.
+        """
+        result = self._generate(self.smart_model, prompt, temperature, num_predict, timeout)
+        return "" if result.startswith("[FALLBACK]") else result
+
     def extract_vector(self, text: str) -> list[float]:
         """
         Embed the text using Ollama's embedding model for ChromaDB / 3D visualization.
@@ -96,6 +178,7 @@ class LLMRouter:
                 json={
                     "model": self.embed_model,
                     "prompt": text,
+                    "keep_alive": OLLAMA_KEEP_ALIVE,
                 },
                 timeout=30
             )
@@ -103,7 +186,118 @@ class LLMRouter:
             embedding = resp.json().get("embedding", [])
             if len(embedding) >= 3:
                 return embedding[:3]  # First 3 dims for quick 3D preview
-            return [random.uniform(-1, 1) for _ in range(3)]
+            return [self.rng.uniform(-1, 1) for _ in range(3)]
         except Exception as e:
             print(f"[LLMRouter] Embedding failed: {e}")
-            return [random.uniform(-1, 1) for _ in range(3)]
+            return [self.rng.uniform(-1, 1) for _ in range(3)]
+
+
+def prewarm_models(keep_alive: str = OLLAMA_KEEP_ALIVE) -> dict:
+    """
+    Load the daily, reflection and embedding models into Ollama in parallel so the
+    first turn does not pay for cold model loads. Returns {model: seconds or None on failure}.
+    """
+    router = LLMRouter()
+    requests_by_model = {
+        router.fast_model: ("api/generate", {"model": router.fast_model, "keep_alive": keep_alive}),
+        router.smart_model: ("api/generate", {"model": router.smart_model, "keep_alive": keep_alive}),
+        router.embed_model: ("api/embeddings", {"model": router.embed_model, "prompt": "warmup", "keep_alive": keep_alive}),
+    }
+
+    def load(model: str):
+        path, payload = requests_by_model[model]
+        started = time.perf_counter()
+        try:
+            resp = requests.post(f"{OLLAMA_BASE_URL}/{path}", json=payload, timeout=300)
+            resp.raise_for_status()
+            return time.perf_counter() - started
+        except Exception as e:
+            print(f"[LLMRouter] Prewarm failed ({model}): {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(requests_by_model)) as pool:
+        timings = dict(zip(requests_by_model, pool.map(load, requests_by_model)))
+    loaded = ", ".join(f"{m} {t:.1f}s" for m, t in timings.items() if t is not None)
+    if loaded:
+        print(f"[LLMRouter] Prewarmed: {loaded}")
+    return timings
+
+
+class StubLLMRouter(LLMRouter):
+    """
+    Offline backend that answers from templates. No network, no model load:
+    used to fast-forward thousands of turns for scaling studies.
+    """
+    DAILY_TEMPLATES = [
+        "I gather berries near the river and share them with my neighbors.",
+        "I explore the eastern hills and discover a cave full of strange markings.",
+        "I craft a new stone tool and teach the children how to use it.",
+        "I talk with the elder about the shape of the stars.",
+        "I rest by the fire, tired after a long day of hunting.",
+        "I wonder what lies beyond the great forest.",
+    ]
+    LEGEND_TEMPLATES = [
+        "The river spirit rose from the water and blessed the village with silver fish.",
+        "A giant beast with eyes of fire guarded the cave, until the bravest of us tamed it.",
+        "The stars whispered the secret of fire to the elder, and the night was never dark again.",
+        "The ancestors walked the eastern hills, carving the laws of the world into stone.",
+    ]
+
+    def _call_ollama(self, model: str, prompt: str, temperature: float = 0.7,
+                     num_predict: int = 120, timeout: int = 60, seed: Optional[int] = None) -> str:
+        templates = self.DAILY_TEMPLATES if model == self.fast_model else self.LEGEND_TEMPLATES
+        numbered = _NUMBERED_LINE.findall(prompt)
+        if model == self.smart_model and numbered:
+            # rewrite_batch: answer every numbered memory
+            return "\n".join(f"{number}. {self.rng.choice(templates)}" for number, _ in numbered)
+        return self.rng.choice(templates)
+
+    def extract_vector(self, text: str) -> list[float]:
+        return [self.rng.uniform(-1, 1) for _ in range(3)]
+
+
+class ReplayLLMRouter(LLMRouter):
+    """
+    Record/replay backend. Responses are cached per (model, temperature, prompt)
+    in call order, so a run with the same seed replays the exact same text.
+    Cache misses go to Ollama and are recorded; call save() to persist them.
+    """
+    def __init__(self, cache_path: str, rng: Optional[random.Random] = None):
+        super().__init__(rng=rng)
+        self.cache_path = cache_path
+        self._cache = defaultdict(list)
+        self._occurrence = defaultdict(int)
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                self._cache.update(json.load(f))
+        self.hits = 0
+        self.misses = 0
+
+    def _call_ollama(self, model: str, prompt: str, temperature: float = 0.7,
+                     num_predict: int = 120, timeout: int = 60, seed: Optional[int] = None) -> str:
+        key = hashlib.sha256(f"{model}\0{temperature}\0{prompt}".encode("utf-8")).hexdigest()
+        index = self._occurrence[key]
+        self._occurrence[key] += 1
+        responses = self._cache[key]
+        if index < len(responses):
+            self.hits += 1
+            return responses[index]
+
+        self.misses += 1
+        # Fallbacks are recorded too so later occurrences keep their positions
+        result = super()._call_ollama(model, prompt, temperature, num_predict, timeout, seed)
+        responses.append(result)
+        return result
+
+    def get_state(self) -> Optional[dict]:
+        # Positions in the per-prompt response lists, so a resumed run replays the next response
+        return {"occurrence": dict(self._occurrence)}
+
+    def set_state(self, state: Optional[dict]):
+        self._occurrence = defaultdict(int, (state or {}).get("occurrence", {}))
+
+    def save(self):
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
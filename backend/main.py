@@ -1,20 +1,46 @@
 import os
-import shutil
+import threading
+from contextlib import asynccontextmanager
 from typing import Optional, List
+import requests
 from fastapi import FastAPI, Depends, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-import chromadb
 
-from database import get_db, engine, Base
+from database import get_db, init_db, SessionLocal
 import models
+from memory import get_chroma_client, get_chroma_collection
+from llm_router import OLLAMA_BASE_URL
+from event_archive import query_events, latest_events
+from search_index import search_events
+from analytics import get_series
+from curated_art import (
+    CachedStaticFiles, UploadSizeLimit, UploadTooLarge, UnsupportedImage, EpochNotFound, save_upload, epoch_images,
+    MAX_UPLOAD_BYTES,
+)
+from profiling import PROFILE_DIR, PROFILE_SLOW_REQUEST_MS, request_profile, profiled_route_class
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables if they don't exist (at startup, not on import)
+    init_db()
+    # Open ChromaDB in the background so the first /api/universe call is warm
+    threading.Thread(target=_get_chroma_collection, daemon=True).start()
+    yield
+
 
-# Create tables if they don't exist
-Base.metadata.create_all(bind=engine)
+app = FastAPI(title="Entropy Civil API", lifespan=lifespan)
 
-app = FastAPI(title="Entropy Civil API")
+# Opt-in: sample every endpoint and keep the profiles of requests slower than the threshold
+if PROFILE_SLOW_REQUEST_MS > 0:
+    app.router.route_class = profiled_route_class()
 
+# Reject oversized artwork uploads by Content-Length or while their body is received.
+# Added before CORS so CORS wraps it and its 413 responses are readable cross-origin.
+app.add_middleware(UploadSizeLimit)
 # Add CORS so React frontend can fetch data
 app.add_middleware(
     CORSMiddleware,
@@ -28,15 +54,14 @@ app.add_middleware(
 static_dir = os.path.join(os.path.dirname(__file__), "static")
 os.makedirs(static_dir, exist_ok=True)
 os.makedirs(os.path.join(static_dir, "curated_art"), exist_ok=True)
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+app.mount("/static", CachedStaticFiles(directory=static_dir), name="static")
 
-_CHROMA_DATA_PATH = os.path.join(os.path.dirname(__file__), "chroma_data_v2")
-try:
-    chroma_client = chromadb.PersistentClient(path=_CHROMA_DATA_PATH)
-    chroma_collection = chroma_client.get_or_create_collection(name="civilization_memories")
-except Exception as e:
-    print(f"Failed to initialize ChromaDB: {e}")
-    chroma_collection = None
+def _get_chroma_collection():
+    try:
+        return get_chroma_collection()
+    except Exception as e:
+        print(f"Failed to initialize ChromaDB: {e}")
+        return None
 
 @app.get("/")
 def read_root():
@@ -44,11 +69,38 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok"}
+    """Readiness probe: DB and ChromaDB are required, Ollama only degrades the simulation"""
+    checks = {}
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+        checks["db"] = "ok"
+    except Exception as e:
+        checks["db"] = f"error: {e}"
+    finally:
+        db.close()
+
+    try:
+        get_chroma_client().heartbeat()
+        checks["chroma"] = "ok"
+    except Exception as e:
+        checks["chroma"] = f"error: {e}"
+
+    try:
+        requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=2).raise_for_status()
+        checks["ollama"] = "ok"
+    except Exception as e:
+        checks["ollama"] = f"error: {e}"
+
+    if checks["db"] != "ok" or checks["chroma"] != "ok":
+        return JSONResponse(status_code=503, content={"status": "unavailable", "checks": checks})
+    status = "ok" if checks["ollama"] == "ok" else "degraded"
+    return {"status": status, "checks": checks}
 
 @app.get("/api/universe")
 def get_universe_data():
     """Return vector data for 3D mapping"""
+    chroma_collection = _get_chroma_collection()
     if not chroma_collection:
         return {"error": "ChromaDB not connected", "data": []}
         
@@ -86,33 +138,113 @@ def get_universe_data():
         return {"error": str(e), "data": []}
 
 @app.get("/api/history")
-def get_historical_logs(limit: int = 50, db: Session = Depends(get_db)):
-    """Return stream of recent simulation events"""
-    logs = db.query(models.SimulationEvent).order_by(models.SimulationEvent.id.desc()).limit(limit).all()
-    # Return in reverse so oldest is first in the output
-    return {"logs": [{"id": l.id, "turn": l.turn, "type": l.event_type, "content": l.content} for l in reversed(logs)]}
+def get_historical_logs(
+    limit: int = 50,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """Return stream of recent simulation events, or a turn range (archived ranges included)"""
+    if turn_start is not None or turn_end is not None:
+        logs = query_events(db, turn_start=turn_start, turn_end=turn_end, limit=limit)
+    else:
+        # Return in reverse so oldest is first in the output
+        logs = list(reversed(latest_events(db, limit)))
+    return {"logs": [{"id": l.id, "turn": l.turn, "type": l.event_type, "content": l.content} for l in logs]}
+
+@app.get("/api/search")
+def search_history(
+    q: str,
+    event_type: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    order: str = "rank",
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Full-text search over event content with highlighted snippets and keyset pagination"""
+    try:
+        return search_events(
+            db, q,
+            event_type=event_type,
+            agent_id=agent_id,
+            turn_start=turn_start,
+            turn_end=turn_end,
+            order=order,
+            limit=max(1, min(limit, 100)),
+            cursor=cursor,
+        )
+    except ValueError as e:
+        return {"error": str(e), "results": [], "next_cursor": None}
+
+@app.get("/api/stats")
+def get_stats(
+    bucket: int = 100,
+    event_type: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    group_by: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Return time series of event/fallback counts served from the incremental rollups"""
+    try:
+        series = get_series(
+            db,
+            bucket=bucket,
+            event_type=event_type,
+            agent_id=agent_id,
+            turn_start=turn_start,
+            turn_end=turn_end,
+            group_by=group_by,
+        )
+        return {"bucket": bucket, "series": series}
+    except ValueError as e:
+        return {"error": str(e), "series": []}
+
+@app.post("/api/profile")
+def trigger_profile(turns: int = 5, mode: str = "sample", memory: bool = False):
+    """Ask simulation processes running with --profile-hooks to profile their next turns"""
+    try:
+        return {"status": "requested", "request": request_profile(turns, mode=mode, memory=memory)}
+    except ValueError as e:
+        return {"error": str(e)}
+
+@app.get("/api/profile")
+def list_profiles(limit: int = 50):
+    """List the newest profile outputs in PROFILE_DIR"""
+    if not os.path.isdir(PROFILE_DIR):
+        return {"directory": PROFILE_DIR, "files": []}
+    entries = [e for e in os.scandir(PROFILE_DIR) if e.is_file() and not e.name.endswith((".json", ".tmp"))]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    files = [{"name": e.name, "size": e.stat().st_size, "modified": e.stat().st_mtime} for e in entries[:limit]]
+    return {"directory": PROFILE_DIR, "files": files}
 
 @app.get("/api/epochs")
 def get_historical_epochs(db: Session = Depends(get_db)):
     """Return timeline of epochs"""
     epochs = db.query(models.HistoricalEpoch).order_by(models.HistoricalEpoch.turn_start.asc()).all()
-    
-    # Also look for images in static folder
+    images_by_epoch = epoch_images(db, [e.id for e in epochs])
+
     result = []
     for e in epochs:
-        # Simple check for image: [epoch_id].jpg
-        image_path_relative = f"/static/curated_art/{e.id}.jpg"
-        image_path_absolute = os.path.join(static_dir, "curated_art", f"{e.id}.jpg")
-        
-        # Check if the image actually exists on the filesystem to prevent 404s
-        image_url = image_path_relative if os.path.exists(image_path_absolute) else None
-        
+        # Content-hashed variants (thumb / medium / webp / original) of the latest upload
+        images = images_by_epoch.get(e.id, {})
+        image_url = images.get("medium") or images.get("original")
+        if image_url is None:
+            # Legacy upload: [epoch_id].jpg, only if it actually exists to prevent 404s
+            legacy_path = os.path.join(static_dir, "curated_art", f"{e.id}.jpg")
+            image_url = f"/static/curated_art/{e.id}.jpg" if os.path.exists(legacy_path) else None
+
         result.append({
             "id": e.id, 
             "name": e.epoch_name, 
             "turn_start": e.turn_start,
             "master_prompt": e.master_prompt,
-            "image_url": image_url
+            "image_url": image_url,
+            "images": images
         })
     return {"epochs": result}
 
@@ -131,17 +263,20 @@ def get_sandbox_state():
 
 @app.post("/api/epochs/{epoch_id}/upload")
 async def upload_epoch_image(epoch_id: int, file: UploadFile = File(...)):
-    """Upload an image for a specific epoch"""
+    """Upload an image for a specific epoch (thumbnail/medium/WebP are generated in the background)"""
     if not file.content_type.startswith("image/"):
         return {"error": "File must be an image"}
-        
-    image_path = os.path.join(static_dir, "curated_art", f"{epoch_id}.jpg")
-    
+
     try:
-        with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        return {"status": "success", "message": f"Image uploaded for epoch {epoch_id}"}
+        images = await save_upload(epoch_id, file)
+        return {"status": "success", "message": f"Image uploaded for epoch {epoch_id}", "images": images}
+    except UploadTooLarge:
+        return JSONResponse(status_code=413, content={"error": f"File exceeds {MAX_UPLOAD_BYTES} bytes"})
+    except UnsupportedImage as e:
+        return JSONResponse(status_code=415, content={"error": str(e)})
+    except EpochNotFound as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
     except Exception as e:
-        return {"error": str(e)}
+        return JSONResponse(status_code=500, content={"error": f"Could not save the upload: {e}"})
 
 # Run with: uvicorn main:app --reload --port 8002
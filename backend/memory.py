@@ -1,14 +1,32 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from pydantic import BaseModel, Field
 import random
 import uuid
 import os
-import chromadb
+import threading
 
 # Use local PersistentClient — no Docker server needed.
 # Data is saved to ./chroma_data_v2 inside the backend directory.
-_CHROMA_DATA_PATH = os.path.join(os.path.dirname(__file__), "chroma_data_v2")
-chroma_client = chromadb.PersistentClient(path=_CHROMA_DATA_PATH)
+_CHROMA_DATA_PATH = os.getenv("CHROMA_DATA_PATH", os.path.join(os.path.dirname(__file__), "chroma_data_v2"))
+COLLECTION_NAME = "civilization_memories"
+
+# chromadb is slow to import and open, so both happen on first use
+_chroma_client = None
+_chroma_lock = threading.Lock()
+
+
+def get_chroma_client():
+    global _chroma_client
+    if _chroma_client is None:
+        with _chroma_lock:
+            if _chroma_client is None:
+                import chromadb
+                _chroma_client = chromadb.PersistentClient(path=_CHROMA_DATA_PATH)
+    return _chroma_client
+
+
+def get_chroma_collection():
+    return get_chroma_client().get_or_create_collection(name=COLLECTION_NAME)
 
 
 class MemoryItem(BaseModel):
@@ -19,57 +37,68 @@ class MemoryItem(BaseModel):
     entropy_level: float = 0.0 # How "degraded" or hallucinated this memory is
 
 class MemorySystem:
-    def __init__(self, agent_id: str):
+    def __init__(self, agent_id: str, rng: Optional[random.Random] = None):
         self.agent_id = agent_id
         self.short_term: List[MemoryItem] = []
-        
+        self.rng = rng or random.Random()
+        self._collection = None
+
+    @property
+    def collection(self):
         # Connect to a shared ChromaDB collection for all agents' long-term memory
-        self.collection = chroma_client.get_or_create_collection(name="civilization_memories")
+        if self._collection is None:
+            self._collection = get_chroma_collection()
+        return self._collection
         
-    def add_memory(self, content: str, importance: float, timestamp: int):
-        item = MemoryItem(content=content, importance=importance, timestamp=timestamp)
+    def add_memory(self, content: str, importance: float, timestamp: int, entropy_level: float = 0.0):
+        item = MemoryItem(content=content, importance=importance, timestamp=timestamp, entropy_level=entropy_level)
         self.short_term.append(item)
-        
+
+    def pending_reflection(self) -> List[MemoryItem]:
+        """Short-term memories important enough to be carried into long-term memory."""
+        return [mem for mem in self.short_term if mem.importance >= 0.5]
+
+    def store_reflection(self, items: List[MemoryItem]):
+        """Write reflected memories to ChromaDB in one upsert and clear short-term memory."""
+        if items:
+            # Provide explicit embeddings to bypass ChromaDB's default embedding function which crashes on some macOS systems with ONNX/CoreML errors
+            mock_embeddings = [[self.rng.uniform(-1, 1), self.rng.uniform(-1, 1), self.rng.uniform(-1, 1)] for _ in items]
+
+            # Store to ChromaDB
+            self.collection.upsert(
+                ids=[mem.id for mem in items],
+                documents=[mem.content for mem in items],
+                metadatas=[{
+                    "agent_id": self.agent_id,
+                    "timestamp": mem.timestamp,
+                    "importance": mem.importance,
+                    "entropy_level": mem.entropy_level
+                } for mem in items],
+                embeddings=mock_embeddings
+            )
+
+        # Clear short term after reflecting
+        self.short_term = []
+
     def reflect_and_summarize(self, current_time: int) -> List[MemoryItem]:
         """
         Periodically compresses short-term memories into long-term.
         This is where ENTROPY (hallucination) is artificially introduced to create myths.
         """
-        summarized = []
-        for mem in self.short_term:
-            if mem.importance >= 0.5:
-                # Add noise (entropy) based on time passed or random chance
-                degraded_content = self._apply_entropy(mem.content)
-                mem.content = degraded_content
-                mem.entropy_level += 0.1
-                
-                import random
-                # Provide explicit embeddings to bypass ChromaDB's default embedding function which crashes on some macOS systems with ONNX/CoreML errors
-                mock_embedding = [random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)]
-                
-                # Store to ChromaDB
-                self.collection.upsert(
-                    ids=[mem.id],
-                    documents=[mem.content],
-                    metadatas=[{
-                        "agent_id": self.agent_id,
-                        "timestamp": mem.timestamp,
-                        "importance": mem.importance,
-                        "entropy_level": mem.entropy_level
-                    }],
-                    embeddings=[mock_embedding]
-                )
-                summarized.append(mem)
-        
-        # Clear short term after reflecting
-        self.short_term = []
+        summarized = self.pending_reflection()
+        # Add noise (entropy) based on time passed and how distorted each memory already is
+        self._apply_entropy(summarized, current_time)
+        self.store_reflection(summarized)
         return summarized
 
-    def _apply_entropy(self, content: str) -> str:
-        # Placeholder for LLM-based hallucination injection
-        # e.g., "I saw a large wolf" -> "I saw a giant beast with red eyes"
-        # If random.random() < 0.2: LLM rewrite with exaggeration prompt
-        return content
+    def _apply_entropy(self, items: List[MemoryItem], current_time: int) -> List[MemoryItem]:
+        """
+        Local entropy tier: seeded, vectorized exaggeration of the memories (in place).
+        Returns the memories that crossed the escalation threshold and deserve an LLM rewrite.
+        e.g., "I saw a big wolf" -> "I beheld a colossal shadow beast"
+        """
+        from entropy_engine import default_engine  # numpy is imported on first reflection
+        return default_engine().apply(items, current_time, self.rng)
 
     def retrieve_relevant(self, query: str, top_k: int = 5) -> List[Any]:
         # Search ChromaDB
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Boolean, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Boolean, Float, ForeignKey, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -14,6 +14,20 @@ class SimulationEvent(Base):
     vector_hash = Column(String, nullable=True) # Link to ChromaDB if stored
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+class EventRollup(Base):
+    __tablename__ = "event_rollups"
+    __table_args__ = (
+        UniqueConstraint("bucket_start", "event_type", "agent_id", name="uq_event_rollups_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    bucket_start = Column(Integer, index=True)  # First turn of the bucket (see analytics.ROLLUP_BUCKET_TURNS)
+    event_type = Column(String)
+    agent_id = Column(String)
+    event_count = Column(Integer, default=0)
+    fallback_count = Column(Integer, default=0)  # LLM fallbacks that were skipped instead of saved
+    content_length_sum = Column(Integer, default=0)
+
 class HistoricalEpoch(Base):
     __tablename__ = "historical_epochs"
 
@@ -0,0 +1,327 @@
+"""
+Profiling - 実行中のシミュレーションと API をその場でプロファイルするモジュール
+
+再起動せずに「急に遅くなったターン」や「遅い API リクエスト」の中身を見るためのフック。
+すべてオプトインで、無効時はフック自体が登録されないのでオーバーヘッドはゼロ。
+
+- ターンのプロファイル (PROFILE_HOOKS=1 または --profile-hooks):
+  SIGUSR1 を送るか POST /api/profile でトリガーファイルを書くと、次の N ターンだけ
+  サンプリングプロファイラ (mode="sample") または cProfile (mode="cprofile") が動く。
+  memory=True なら tracemalloc のスナップショットをターン毎に差分し、short_term の件数と一緒に出力する。
+  待機中のコストは1ターンに stat() 1回だけ
+- API のプロファイル (PROFILE_SLOW_REQUEST_MS=500 など):
+  各リクエストのハンドラを実行するスレッドをサンプリングし、閾値より遅かったものだけ保存する
+
+出力先は PROFILE_DIR (default: backend/profiles/)。
+*.folded は collapsed-stack 形式 (flamegraph.pl / speedscope でそのまま開ける)、
+*.pstats は cProfile の統計 (snakeviz など)、*.memory.txt は tracemalloc の差分。
+"""
+import os
+import re
+import sys
+import json
+import time
+import signal
+import inspect
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_HOOKS = os.getenv("PROFILE_HOOKS", "0") == "1"
+PROFILE_TURNS = int(os.getenv("PROFILE_TURNS", "5"))                      # Window length for SIGUSR1
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # Seconds between stack samples
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", "0"))  # 0 = API profiling disabled
+PROFILE_MODES = ("sample", "cprofile")
+TRIGGER_FILE = "trigger.json"
+MEMORY_TOP_LINES = 15
+
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# ─── Sampling profiler ────────────────────────────────────────────
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Samples one thread's stack from a background thread into collapsed-stack counts."""
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.paused = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="stack-sampler")
+
+    def start(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self.paused = True  # Do not sample the caller waiting in join()
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.paused:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[_collapse(frame)] += 1
+
+
+def write_folded(path: str, counts: Counter):
+    _write_atomic(path, "".join(f"{stack} {n}\n" for stack, n in counts.most_common()))
+
+
+# ─── Turn profiling ───────────────────────────────────────────────
+
+def request_profile(turns: int = PROFILE_TURNS, mode: str = "sample", memory: bool = False) -> dict:
+    """
+    Ask every process running with profiling hooks to profile its next `turns` turns.
+    Used by POST /api/profile; raises ValueError on bad input.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+    if not 1 <= turns <= 1000:
+        raise ValueError("turns must be between 1 and 1000")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    req = {"turns": turns, "mode": mode, "memory": memory, "requested_at": time.time()}
+    _write_atomic(os.path.join(PROFILE_DIR, TRIGGER_FILE), json.dumps(req))
+    return req
+
+
+class TurnProfiler:
+    """
+    Profiles a window of turns on request. Call before_turn()/after_turn() around each turn;
+    they only poll for a trigger until a window is requested.
+    """
+
+    def __init__(self, tag: str = "sim", directory: str = PROFILE_DIR):
+        self.tag = tag
+        self.directory = directory
+        self.trigger_path = os.path.join(directory, TRIGGER_FILE)
+        self._signalled = False
+        self._trigger_mtime = self._mtime()  # Do not replay a trigger written before we started
+        self._window = None
+
+    def install_signal_handler(self):
+        """SIGUSR1 starts a sampling window of PROFILE_TURNS turns (without tracemalloc)."""
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+            print(f"[Profile] Hooks enabled (pid {os.getpid()}): send SIGUSR1 or POST /api/profile.")
+        else:
+            print("[Profile] Hooks enabled: POST /api/profile (SIGUSR1 is not available on this platform).")
+
+    def _on_signal(self, signum, frame):
+        self._signalled = True  # Picked up at the next turn boundary
+
+    def _mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.trigger_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _poll(self) -> Optional[dict]:
+        if self._signalled:
+            self._signalled = False
+            return {"turns": PROFILE_TURNS, "mode": "sample", "memory": False}
+        mtime = self._mtime()
+        if mtime is None or mtime == self._trigger_mtime:
+            return None
+        self._trigger_mtime = mtime
+        try:
+            with open(self.trigger_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[Profile] Ignoring unreadable trigger: {e}")
+            return None
+
+    def before_turn(self, sim):
+        if self._window is None:
+            req = self._poll()
+            if req is None:
+                return
+            self._start(sim, req)
+        w = self._window
+        if w["profile"] is not None:
+            w["profile"].enable()
+        elif w["sampler"] is None:
+            w["sampler"] = StackSampler(threading.get_ident()).start()
+        else:
+            w["sampler"].paused = False
+
+    def after_turn(self, sim):
+        w = self._window
+        if w is None:
+            return
+        if w["profile"] is not None:
+            w["profile"].disable()
+        if w["sampler"] is not None:
+            w["sampler"].paused = True  # Leave the sleep between turns out of the profile
+        w["done"] += 1
+        if w["memory"]:
+            self._record_memory(sim)
+        if w["done"] >= w["turns"]:
+            self._finish(sim)
+
+    def _start(self, sim, req: dict):
+        mode = req.get("mode", "sample")
+        self._window = {
+            "turns": max(1, int(req.get("turns", PROFILE_TURNS))),
+            "done": 0,
+            "start_turn": sim.turn,
+            "started_at": time.perf_counter(),
+            "profile": cProfile.Profile() if mode == "cprofile" else None,
+            "sampler": None,
+            "memory": bool(req.get("memory")),
+            "own_tracemalloc": False,
+            "snapshot": None,
+            "memory_report": [],
+        }
+        if self._window["memory"]:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._window["own_tracemalloc"] = True
+            self._window["snapshot"] = self._snapshot()
+        print(f"[Profile] Profiling turns {sim.turn}..{sim.turn + self._window['turns'] - 1} "
+              f"(mode={mode}, memory={self._window['memory']}).")
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    def _record_memory(self, sim):
+        w = self._window
+        snapshot = self._snapshot()
+        diff = snapshot.compare_to(w["snapshot"], "lineno")
+        w["snapshot"] = snapshot
+        short_term = [len(a.memory.short_term) for a in sim.agents]
+        lines = [
+            f"== turn {sim.turn - 1}: {sum(d.size_diff for d in diff) / 1024:+.1f} KiB traced, "
+            f"short_term total {sum(short_term)} (max {max(short_term, default=0)} per agent)"
+        ]
+        lines += [f"  {stat}" for stat in diff[:MEMORY_TOP_LINES]]
+        w["memory_report"].append("\n".join(lines))
+
+    def _finish(self, sim):
+        w, self._window = self._window, None
+        elapsed = time.perf_counter() - w["started_at"]
+        os.makedirs(self.directory, exist_ok=True)
+        stem = os.path.join(
+            self.directory,
+            f"turns_{w['start_turn']}-{sim.turn - 1}_{self.tag}_{os.getpid()}_{time.strftime('%Y%m%d-%H%M%S')}",
+        )
+        counts = w["sampler"].stop() if w["sampler"] is not None else None
+        written = []
+        try:
+            if w["profile"] is not None:
+                w["profile"].dump_stats(f"{stem}.pstats")
+                with open(f"{stem}.txt", "w", encoding="utf-8") as f:
+                    pstats.Stats(w["profile"], stream=f).sort_stats("cumulative").print_stats(40)
+                written += [f"{stem}.pstats", f"{stem}.txt"]
+            if w["sampler"] is not None:
+                write_folded(f"{stem}.folded", counts)
+                written.append(f"{stem}.folded")
+            if w["memory"]:
+                _write_atomic(f"{stem}.memory.txt", "\n\n".join(w["memory_report"]) + "\n")
+                written.append(f"{stem}.memory.txt")
+        except Exception as e:
+            print(f"[Profile] Failed to write profile: {e}")
+        finally:
+            if w["own_tracemalloc"]:
+                tracemalloc.stop()
+        print(f"[Profile] {w['done']} turns in {elapsed:.2f}s -> {', '.join(os.path.basename(p) for p in written)}")
+
+
+# ─── API request profiling ────────────────────────────────────────
+
+def _request_stem(method: str, path: str, elapsed_ms: float) -> str:
+    slug = re.sub(r"[^\w]+", "_", path).strip("_") or "root"
+    now = time.time()
+    return os.path.join(
+        PROFILE_DIR,
+        f"api_{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}"
+        f"_{method}_{slug}_{elapsed_ms:.0f}ms",
+    )
+
+
+def _save_slow_request(name: str, started: float, counts: Counter):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms < PROFILE_SLOW_REQUEST_MS or not counts:
+        return
+    method, _, path = name.partition(" ")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        write_folded(f"{_request_stem(method, path, elapsed_ms)}.folded", counts)
+        print(f"[Profile] Slow request {name} took {elapsed_ms:.0f}ms ({sum(counts.values())} samples).")
+    except Exception as e:
+        print(f"[Profile] Failed to write request profile: {e}")
+
+
+def profile_endpoint(endpoint, name: str):
+    """
+    Wrap a route endpoint so the thread running it is sampled. Sync endpoints run in the
+    threadpool and are sampled alone; async ones share the event loop thread.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+        from starlette.concurrency import run_in_threadpool
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            sampler = StackSampler(threading.get_ident()).start()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                # stop() joins the sampler thread and saving writes a file; keep both off the event loop
+                counts = await run_in_threadpool(sampler.stop)
+                await run_in_threadpool(_save_slow_request, name, started, counts)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            sampler = StackSampler(threading.get_ident()).start()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _save_slow_request(name, started, sampler.stop())
+    return wrapper
+
+
+def profiled_route_class():
+    """
+    APIRoute that profiles every endpoint. Set as app.router.route_class before the routes
+    are declared, only when PROFILE_SLOW_REQUEST_MS > 0.
+    """
+    from fastapi.routing import APIRoute
+
+    class ProfiledRoute(APIRoute):
+        def __init__(self, path: str, endpoint, **kwargs):
+            methods = ",".join(sorted(kwargs.get("methods") or ["GET"]))
+            super().__init__(path, profile_endpoint(endpoint, f"{methods} {path}"), **kwargs)
+
+    return ProfiledRoute
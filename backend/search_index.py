@@ -0,0 +1,292 @@
+"""
+Search Index - 歴史・リフレクション・伝説の全文検索モジュール
+
+SimulationEvent.content に全文検索インデックスを張り、/api/search から利用する。
+
+- PostgreSQL: to_tsvector の式インデックス (GIN)。パーティション親テーブルに作成するので
+  新しいパーティションにも自動で伝播し、INSERT 時に増分更新される
+- SQLite (ローカル実行): FTS5 外部コンテンツテーブル + INSERT/DELETE トリガーで増分更新
+
+検索結果はスコア順 (order="rank") またはターン順 (order="turn") で、
+キーセットページネーション用の cursor を返す。
+
+アーカイブ (event_archive) されたターンはデフォルトでは検索対象外で、レスポンスの
+searched_from_turn でどこから先を検索したかを返す。
+SEARCH_ARCHIVE_TURNS=N (PostgreSQL のみ) を指定すると、アーカイブ境界から遡って N ターン分を
+検索専用のサイドテーブル simulation_events_archived (GIN 付き) に残し、hot テーブルと
+UNION ALL して検索する。本文を DB に二重に持つことになるので、その分だけアーカイブによる
+DB サイズの上限が N ターン分広がる (N を全履歴より大きくすると上限がなくなる)。
+窓から外れた行はアーカイブのたびに削除し、窓内で未登録のセグメントは起動時に manifest から取り込む。
+SQLite ではアーカイブが行われないので hot テーブルだけで全履歴になる。
+"""
+import os
+import re
+import json
+import base64
+from typing import Optional, List
+from sqlalchemy import text
+from database import get_engine
+import models
+
+SEARCH_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "english")  # Postgres text search configuration
+SEARCH_ARCHIVE_TURNS = int(os.getenv("SEARCH_ARCHIVE_TURNS", "0"))  # Archived turns kept searchable (0 = none)
+SNIPPET_START, SNIPPET_STOP = "<mark>", "</mark>"
+
+_TABLE = models.SimulationEvent.__tablename__
+_FTS_TABLE = f"{_TABLE}_fts"
+_PG_INDEX = f"ix_{_TABLE}_content_fts"
+_ARCHIVE_TABLE = f"{_TABLE}_archived"
+_ARCHIVE_COLUMNS = "id, turn, agent_id, event_type, content"
+_BACKFILL_BATCH = 5000
+
+if not re.fullmatch(r"\w+", SEARCH_TS_CONFIG):
+    raise ValueError(f"Invalid SEARCH_TS_CONFIG: {SEARCH_TS_CONFIG!r}")
+
+_PG_TSVECTOR = f"to_tsvector('{SEARCH_TS_CONFIG}'::regconfig, coalesce(e.content, ''))"
+
+
+def prepare_search_index():
+    """Create the full-text index (idempotent). Must run after the events table exists."""
+    dialect = get_engine().dialect.name
+    try:
+        with get_engine().begin() as conn:
+            if dialect == "postgresql":
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {_PG_INDEX} ON {_TABLE} "
+                    f"USING GIN ({_PG_TSVECTOR.replace('e.content', 'content')})"
+                ))
+                _prepare_archive_table(conn)
+            elif dialect == "sqlite":
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": _FTS_TABLE},
+                ).first()
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {_FTS_TABLE} "
+                    f"USING fts5(content, content='{_TABLE}', content_rowid='id')"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {_FTS_TABLE}_ai AFTER INSERT ON {_TABLE} BEGIN "
+                    f"INSERT INTO {_FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {_FTS_TABLE}_ad AFTER DELETE ON {_TABLE} BEGIN "
+                    f"INSERT INTO {_FTS_TABLE}({_FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END"
+                ))
+                if not exists:
+                    # Index rows written before the FTS table existed
+                    conn.execute(text(f"INSERT INTO {_FTS_TABLE}({_FTS_TABLE}) VALUES ('rebuild')"))
+                    print(f"[Search] Built FTS5 index '{_FTS_TABLE}'.")
+            else:
+                print(f"[Search] Full-text search is not supported on '{dialect}'.")
+    except Exception as e:
+        print(f"[Search] Could not prepare search index: {e}")
+
+
+def searched_from_turn() -> int:
+    """First turn /api/search can find: the archive boundary, minus SEARCH_ARCHIVE_TURNS when enabled."""
+    from event_archive import archived_turn_end
+
+    archive_end = archived_turn_end()
+    if SEARCH_ARCHIVE_TURNS > 0 and get_engine().dialect.name == "postgresql":
+        return max(0, archive_end - SEARCH_ARCHIVE_TURNS)
+    return archive_end
+
+
+def _prepare_archive_table(conn):
+    if SEARCH_ARCHIVE_TURNS <= 0:
+        exists = conn.execute(text("SELECT to_regclass(:name)"), {"name": _ARCHIVE_TABLE}).scalar()
+        if exists:
+            # Derived from the segments, so it can be rebuilt by enabling SEARCH_ARCHIVE_TURNS again
+            conn.execute(text(f"DROP TABLE {_ARCHIVE_TABLE}"))
+            print(f"[Search] SEARCH_ARCHIVE_TURNS is 0; dropped '{_ARCHIVE_TABLE}'.")
+        return
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {_ARCHIVE_TABLE} ("
+        f"id BIGINT PRIMARY KEY, turn INTEGER NOT NULL, agent_id VARCHAR, event_type VARCHAR, content TEXT)"
+    ))
+    conn.execute(text(
+        f"CREATE INDEX IF NOT EXISTS ix_{_ARCHIVE_TABLE}_content_fts ON {_ARCHIVE_TABLE} "
+        f"USING GIN ({_PG_TSVECTOR.replace('e.content', 'content')})"
+    ))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{_ARCHIVE_TABLE}_turn ON {_ARCHIVE_TABLE} (turn)"))
+    floor = searched_from_turn()
+    conn.execute(text(f"DELETE FROM {_ARCHIVE_TABLE} WHERE turn < :floor"), {"floor": floor})
+    _backfill_archive_table(conn, floor)
+
+
+def _backfill_archive_table(conn, floor: int):
+    """
+    Index segments in the search window that are not in the side table yet (archived before
+    it existed or before the window grew), skipping partitions that are still attached.
+    """
+    from event_archive import _load_manifest, _read_segment, _list_partitions, is_partitioned
+
+    attached = {(start, end) for _, start, end in _list_partitions(conn)} if is_partitioned() else set()
+    total = 0
+    for seg in _load_manifest():
+        if seg["turn_end"] <= floor or (seg["turn_start"], seg["turn_end"]) in attached:
+            continue
+        present = conn.execute(
+            text(f"SELECT 1 FROM {_ARCHIVE_TABLE} WHERE turn >= :start AND turn < :end LIMIT 1"),
+            {"start": seg["turn_start"], "end": seg["turn_end"]},
+        ).first()
+        if present:
+            continue
+        events = [ev for ev in _read_segment(seg["file"]) if ev.turn >= floor]
+        for i in range(0, len(events), _BACKFILL_BATCH):
+            conn.execute(
+                text(
+                    f"INSERT INTO {_ARCHIVE_TABLE} ({_ARCHIVE_COLUMNS}) "
+                    f"VALUES (:id, :turn, :agent_id, :event_type, :content) ON CONFLICT (id) DO NOTHING"
+                ),
+                [ev.model_dump(include={"id", "turn", "agent_id", "event_type", "content"})
+                 for ev in events[i:i + _BACKFILL_BATCH]],
+            )
+        total += len(events)
+    if total:
+        print(f"[Search] Indexed {total} archived events into '{_ARCHIVE_TABLE}'.")
+
+
+def index_archived_partition(conn, partition: str):
+    """
+    When SEARCH_ARCHIVE_TURNS is set, copy the partition's rows inside the search window into
+    the archive side table and drop rows that left the window. Called by the archive job
+    inside the transaction that drops the partition (after its segment is in the manifest).
+    """
+    if SEARCH_ARCHIVE_TURNS <= 0:
+        return
+    floor = searched_from_turn()
+    conn.execute(
+        text(
+            f"INSERT INTO {_ARCHIVE_TABLE} ({_ARCHIVE_COLUMNS}) "
+            f"SELECT {_ARCHIVE_COLUMNS} FROM {partition} WHERE turn >= :floor ON CONFLICT (id) DO NOTHING"
+        ),
+        {"floor": floor},
+    )
+    conn.execute(text(f"DELETE FROM {_ARCHIVE_TABLE} WHERE turn < :floor"), {"floor": floor})
+
+
+def encode_cursor(sort_value, event_id: int) -> str:
+    raw = json.dumps([sort_value, event_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor. Raises ValueError on malformed input."""
+    try:
+        sort_value, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(sort_value), int(event_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _fts5_query(query: str) -> str:
+    # Quote every term so user input can never be parsed as FTS5 syntax (implicit AND)
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def search_events(
+    db,
+    query: str,
+    event_type: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    turn_start: Optional[int] = None,
+    turn_end: Optional[int] = None,
+    order: str = "rank",
+    limit: int = 20,
+    cursor: Optional[str] = None,
+) -> dict:
+    """
+    Ranked full-text search over event content.
+    Returns {"results": [...], "next_cursor": str | None, "searched_from_turn": int};
+    turns before searched_from_turn are archived and were not searched.
+    """
+    if order not in ("rank", "turn"):
+        raise ValueError("order must be 'rank' or 'turn'")
+    if not query.strip():
+        raise ValueError("Empty query")
+
+    dialect = db.get_bind().dialect.name
+    params = {"limit": limit}
+
+    filters = []
+    if event_type is not None:
+        filters.append("e.event_type = :event_type")
+        params["event_type"] = event_type
+    if agent_id is not None:
+        filters.append("e.agent_id = :agent_id")
+        params["agent_id"] = agent_id
+    if turn_start is not None:
+        filters.append("e.turn >= :turn_start")
+        params["turn_start"] = turn_start
+    if turn_end is not None:
+        filters.append("e.turn < :turn_end")
+        params["turn_end"] = turn_end
+    filter_sql = "".join(f" AND {f}" for f in filters)
+
+    if dialect == "postgresql":
+        rank_sql = f"ts_rank({_PG_TSVECTOR}, q.query)"
+        rank_param = "CAST(:cursor_sort AS real)"  # ts_rank returns real; compare at the same precision
+        source = _TABLE
+        if SEARCH_ARCHIVE_TURNS > 0:
+            source = (f"(SELECT {_ARCHIVE_COLUMNS} FROM {_TABLE} "
+                      f"UNION ALL SELECT {_ARCHIVE_COLUMNS} FROM {_ARCHIVE_TABLE})")
+        sql = (
+            f"WITH q AS (SELECT websearch_to_tsquery('{SEARCH_TS_CONFIG}'::regconfig, :query) AS query), "
+            f"hits AS ("
+            f"SELECT e.id, e.turn, e.agent_id, e.event_type, e.content, {rank_sql} AS rank "
+            f"FROM {source} e, q WHERE {_PG_TSVECTOR} @@ q.query{filter_sql}"
+            f") "
+            f"SELECT id, turn, agent_id, event_type, rank, "
+            f"ts_headline('{SEARCH_TS_CONFIG}'::regconfig, content, (SELECT query FROM q), "
+            f"'StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxFragments=2, MaxWords=20, MinWords=5') AS snippet "
+            f"FROM hits WHERE {{keyset}} ORDER BY {{order_by}} LIMIT :limit"
+        )
+        params["query"] = query
+    elif dialect == "sqlite":
+        rank_param = ":cursor_sort"
+        sql = (
+            f"SELECT * FROM ("
+            f"SELECT e.id, e.turn, e.agent_id, e.event_type, -bm25({_FTS_TABLE}) AS rank, "
+            f"snippet({_FTS_TABLE}, 0, '{SNIPPET_START}', '{SNIPPET_STOP}', '…', 16) AS snippet "
+            f"FROM {_FTS_TABLE} JOIN {_TABLE} e ON e.id = {_FTS_TABLE}.rowid "
+            f"WHERE {_FTS_TABLE} MATCH :query{filter_sql}"
+            f") WHERE {{keyset}} ORDER BY {{order_by}} LIMIT :limit"
+        )
+        params["query"] = _fts5_query(query)
+    else:
+        raise ValueError(f"Full-text search is not supported on '{dialect}'")
+
+    if order == "rank":
+        order_by = "rank DESC, id DESC"
+        keyset = f"(rank < {rank_param} OR (rank = {rank_param} AND id < :cursor_id))"
+    else:
+        order_by = "turn ASC, id ASC"
+        keyset = "(turn > :cursor_sort OR (turn = :cursor_sort AND id > :cursor_id))"
+
+    if cursor:
+        params["cursor_sort"], params["cursor_id"] = decode_cursor(cursor)
+        if order == "turn":
+            params["cursor_sort"] = int(params["cursor_sort"])
+    else:
+        keyset = "1 = 1"
+
+    rows = db.execute(text(sql.format(keyset=keyset, order_by=order_by)), params).mappings().all()
+
+    results: List[dict] = [
+        {
+            "id": r["id"],
+            "turn": r["turn"],
+            "agent_id": r["agent_id"],
+            "type": r["event_type"],
+            "rank": float(r["rank"]),
+            "snippet": r["snippet"],
+        }
+        for r in rows
+    ]
+    next_cursor = None
+    if len(results) == limit:
+        last = results[-1]
+        next_cursor = encode_cursor(last["rank"] if order == "rank" else last["turn"], last["id"])
+    return {"results": results, "next_cursor": next_cursor, "searched_from_turn": searched_from_turn()}
@@ -0,0 +1,380 @@
+"""
+Sharding - エージェントを「村 (village)」単位のシャードに分割し、複数プロセス/ノードで実行するモジュール
+
+Simulation は全エージェントを1プロセスで動かすため、数十エージェントを超えると
+1コア・1リクエストキューが上限になる。
+
+- coordinator: ターンを配布し、全シャードの完了 (バリア) を待ってからエポック検出・年代記・
+  アーカイブなどのターン単位フェーズを1回だけ実行する。
+  --staleness k を指定すると、シャードは全体の完了ターンより最大 k ターン先まで進める
+- worker: 1つの村のエージェントだけを持つ Simulation を動かし、その村で生まれた伝説を
+  coordinator 経由で他の村へ「噂」として届ける
+- 通信は multiprocessing.connection (TCP + authkey) 上の JSON メッセージ (pickle は使わない)。
+  ローカルでは coordinator が worker を起動し、実行ごとにランダムな authkey を環境変数で渡す。
+  別ノードでは `python sharding.py worker --coordinator HOST:PORT --shard i` で参加する。
+  ループバック以外で待ち受ける場合と --external-workers の場合は SHARD_AUTHKEY の指定が必須
+
+イベントはこれまで通り各 worker が直接 DB に書き込む。
+
+使い方:
+    python sharding.py coordinator --shards 4 --agents-per-shard 25 --turns 1000 --no-sleep
+"""
+import os
+import sys
+import json
+import time
+import ipaddress
+import subprocess
+import threading
+from collections import defaultdict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, wait
+from typing import Optional, List
+
+SHARD_AUTHKEY = os.getenv("SHARD_AUTHKEY")  # Required for remote workers; local runs generate one
+RUMORS_PER_SHARD = 3  # 1ターンに1つの村から他の村へ届く噂の最大数
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+
+def _parse_address(address: str) -> tuple:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _send(conn, *msg):
+    conn.send_bytes(json.dumps(msg).encode("utf-8"))
+
+
+def _recv(conn) -> list:
+    return json.loads(conn.recv_bytes(MAX_MESSAGE_BYTES))
+
+
+def _shard_seed(seed: Optional[int], shard_id: int) -> Optional[int]:
+    return None if seed is None else seed * 1_000_003 + shard_id
+
+
+# ─── Worker ───────────────────────────────────────────────────────
+
+def run_worker(args):
+    # Checked before any DB, checkpoint or model work so a misconfigured worker exits right away
+    if not SHARD_AUTHKEY:
+        raise SystemExit("[Shard] SHARD_AUTHKEY must be set (the coordinator passes it to local workers).")
+    from simulation import Simulation, build_router
+    from checkpoint import Checkpointer, CHECKPOINT_DIR
+    from profiling import TurnProfiler, PROFILE_HOOKS
+
+    if args.llm == "replay":
+        args.replay_cache = f"{args.replay_cache}.shard{args.shard}"
+    router = build_router(args)
+    checkpointer = None
+    if not args.no_checkpoint:
+        checkpointer = Checkpointer(os.path.join(args.checkpoint_dir or CHECKPOINT_DIR, f"shard_{args.shard}"))
+    sim = Simulation(
+        num_agents=args.agents_per_shard,
+        seed=_shard_seed(args.seed, args.shard),
+        router=router,
+        checkpointer=checkpointer,
+        name_prefix=f"Village{args.shard}-Agent",
+    )
+
+    profiler = None
+    if args.profile_hooks or PROFILE_HOOKS:
+        profiler = TurnProfiler(tag=f"shard{args.shard}")
+        profiler.install_signal_handler()
+
+    conn = Client(_parse_address(args.coordinator), authkey=SHARD_AUTHKEY.encode("utf-8"))
+    _send(conn, "hello", args.shard, sim.turn)
+    print(f"[Shard {args.shard}] Connected with {len(sim.agents)} agents.")
+    try:
+        while True:
+            msg = _recv(conn)
+            if msg[0] == "stop":
+                break
+            _, turn, inbox = msg
+            started = time.perf_counter()
+            sim.turn = turn
+            if profiler:
+                profiler.before_turn(sim)
+            for content in inbox:
+                sim.deliver_rumor(content)
+            legends = sim.run_agent_phase()
+            snapshot = sim.sandbox_snapshot()
+            sim.turn += 1
+            if sim.checkpointer:
+                sim.checkpointer.save(sim)
+            if profiler:
+                profiler.after_turn(sim)
+            _send(conn, "done", args.shard, turn, legends[:RUMORS_PER_SHARD], snapshot,
+                  time.perf_counter() - started)
+    except (EOFError, ConnectionError):
+        print(f"[Shard {args.shard}] Coordinator went away.")
+    finally:
+        if args.llm == "replay":
+            router.save()
+        conn.close()
+
+
+# ─── Coordinator ──────────────────────────────────────────────────
+
+class Coordinator:
+    def __init__(self, num_shards: int, listener: Listener, router, staleness: int = 0):
+        self.num_shards = num_shards
+        self.listener = listener
+        self.router = router
+        self.staleness = max(0, staleness)
+        self.conns = {}  # shard_id -> Connection
+        self.start_turns = {}
+        # What TurnProfiler reads: the next global turn, and no local agents
+        self.turn = 0
+        self.agents = []
+
+    def accept_workers(self, processes: List[subprocess.Popen] = ()):
+        """Wait for every shard to say hello. Fails fast if a local worker dies before joining."""
+        accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        accept_thread.start()
+        while accept_thread.is_alive():
+            accept_thread.join(timeout=0.5)
+            for proc in processes:
+                if proc.poll() is not None and accept_thread.is_alive():
+                    raise ConnectionError(f"worker pid {proc.pid} exited with {proc.returncode} before joining")
+
+    def _accept_loop(self):
+        while len(self.conns) < self.num_shards:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                print("[Coordinator] Rejected a worker with the wrong SHARD_AUTHKEY.")
+                continue
+            except OSError:
+                return  # Listener closed by stop()
+            try:
+                kind, shard_id, turn = _recv(conn)
+            except (EOFError, OSError, ValueError):
+                conn.close()
+                continue
+            if kind != "hello" or not isinstance(shard_id, int) or not 0 <= shard_id < self.num_shards \
+                    or shard_id in self.conns:
+                print(f"[Coordinator] Rejected worker hello {kind!r} for shard {shard_id}.")
+                conn.close()
+                continue
+            self.conns[shard_id] = conn
+            self.start_turns[shard_id] = turn
+            print(f"[Coordinator] Shard {shard_id} joined ({len(self.conns)}/{self.num_shards}).")
+
+    def run(self, start_turn: int, turns: Optional[int] = None, delay: float = 0.0, profiler=None) -> dict:
+        """
+        Drive all shards from start_turn. A shard may run turn t once every shard has
+        finished turn t - 1 - staleness. Global phases run once per fully finished turn
+        (profiled as the coordinator's turn when a TurnProfiler is given).
+        """
+        from simulation import run_global_phase, write_sandbox_state
+        from event_archive import ensure_partition_for_turn
+
+        end_turn = None if turns is None else start_turn + turns
+        next_turn = {s: start_turn for s in self.conns}
+        completed = {s: start_turn - 1 for s in self.conns}
+        busy = {}  # Connection -> shard_id
+        inbox = defaultdict(list)  # shard_id -> [(turn, source shard, content)]
+        snapshots = {}
+        shard_time = defaultdict(float)
+        global_done = start_turn - 1
+        started = time.perf_counter()
+
+        while True:
+            for shard_id, conn in self.conns.items():
+                t = next_turn[shard_id]
+                if conn in busy or (end_turn is not None and t >= end_turn):
+                    continue
+                if t > global_done + 1 + self.staleness:
+                    continue
+                ensure_partition_for_turn(t)
+                delivered = [content for _, _, content in sorted(inbox.pop(shard_id, []))]
+                _send(conn, "step", t, delivered)
+                busy[conn] = shard_id
+
+            if not busy:
+                break
+
+            for conn in wait(list(busy)):
+                shard_id = busy.pop(conn)
+                _, _, turn, legends, snapshot, elapsed = _recv(conn)
+                completed[shard_id] = turn
+                next_turn[shard_id] = turn + 1
+                snapshots[shard_id] = snapshot
+                shard_time[shard_id] += elapsed
+                for other in self.conns:
+                    if other != shard_id:
+                        inbox[other].extend(
+                            (turn, shard_id, f"[RUMOR from Village {shard_id}] {legend}") for legend in legends
+                        )
+
+            while min(completed.values()) > global_done:
+                global_done += 1
+                print(f"--- Turn {global_done} (all {self.num_shards} villages) ---")
+                self.turn = global_done
+                if profiler:
+                    profiler.before_turn(self)
+                run_global_phase(global_done, self.router)
+                write_sandbox_state(global_done, [a for s in sorted(snapshots) for a in snapshots[s]])
+                self.turn = global_done + 1
+                if profiler:
+                    profiler.after_turn(self)
+                if delay:
+                    time.sleep(delay)  # Wait between turns for readability
+
+        return {
+            "turns": global_done - start_turn + 1,
+            "elapsed": time.perf_counter() - started,
+            "shard_time": dict(shard_time),
+        }
+
+    def stop(self):
+        for conn in self.conns.values():
+            try:
+                _send(conn, "stop")
+                conn.close()
+            except (OSError, ValueError):
+                pass
+        self.listener.close()
+
+
+def _worker_command(args, shard_id: int, address: str) -> List[str]:
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "worker",
+        "--shard", str(shard_id),
+        "--coordinator", address,
+        "--agents-per-shard", str(args.agents_per_shard),
+        "--llm", args.llm,
+        "--replay-cache", args.replay_cache,
+    ]
+    if args.seed is not None:
+        cmd += ["--seed", str(args.seed)]
+    if args.no_checkpoint:
+        cmd.append("--no-checkpoint")
+    if args.checkpoint_dir:
+        cmd += ["--checkpoint-dir", args.checkpoint_dir]
+    if args.profile_hooks:
+        cmd.append("--profile-hooks")
+    return cmd
+
+
+def run_coordinator(args):
+    from simulation import build_router, resume_turn
+    from database import init_db
+    from llm_router import prewarm_models
+    from profiling import TurnProfiler, PROFILE_HOOKS
+
+    init_db()
+    if args.llm != "stub":
+        threading.Thread(target=prewarm_models, daemon=True).start()
+
+    listen_host, listen_port = _parse_address(args.listen)
+    authkey = SHARD_AUTHKEY
+    if not authkey:
+        # Messages are only accepted from peers that know the key, so never default to a shared one
+        if args.external_workers or not _is_loopback(listen_host):
+            raise SystemExit("[Coordinator] Set SHARD_AUTHKEY to listen beyond loopback or to use --external-workers.")
+        authkey = os.urandom(32).hex()
+    listener = Listener((listen_host, listen_port), authkey=authkey.encode("utf-8"))
+    host, port = listener.address
+    address = f"{'127.0.0.1' if host in ('0.0.0.0', '') else host}:{port}"
+    print(f"[Coordinator] Listening on {host}:{port} for {args.shards} shards.")
+
+    router = build_router(args)
+    if args.seed is not None:
+        import random
+        router.use_rng(random.Random(args.seed))
+
+    workers = []
+    if not args.external_workers:
+        worker_env = {**os.environ, "SHARD_AUTHKEY": authkey}
+        workers = [
+            subprocess.Popen(_worker_command(args, shard_id, address), env=worker_env,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            for shard_id in range(args.shards)
+        ]
+
+    profiler = None
+    if args.profile_hooks or PROFILE_HOOKS:
+        profiler = TurnProfiler(tag="coordinator")
+        profiler.install_signal_handler()
+
+    coordinator = Coordinator(args.shards, listener, router, staleness=args.staleness)
+    stats = None
+    try:
+        coordinator.accept_workers(workers)
+        start_turn = max([resume_turn()] + list(coordinator.start_turns.values()))
+        print(f"[Coordinator] Starting at turn {start_turn} (staleness={args.staleness}).")
+        stats = coordinator.run(start_turn, turns=args.turns, delay=0.0 if args.no_sleep else args.sleep,
+                                profiler=profiler)
+    except KeyboardInterrupt:
+        print("Simulation paused.")
+    except (EOFError, ConnectionError) as e:
+        print(f"[Coordinator] Lost a worker: {e!r}. Stopping (workers resume from checkpoints on restart).")
+    finally:
+        coordinator.stop()
+        for proc in workers:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.terminate()
+        if args.llm == "replay":
+            router.save()
+
+    if stats and stats["turns"] > 0:
+        agents = args.shards * args.agents_per_shard
+        print(f"\n{'═'*60}")
+        print(f"[Coordinator] {stats['turns']} turns x {agents} agents ({args.shards} shards) in {stats['elapsed']:.2f}s")
+        print(f"[Coordinator] {stats['turns'] / stats['elapsed']:.2f} turns/s, "
+              f"{stats['turns'] * agents / stats['elapsed']:.2f} agent-turns/s")
+        for shard_id, busy_time in sorted(stats["shard_time"].items()):
+            print(f"[Coordinator] shard {shard_id}: {busy_time / stats['turns'] * 1000:.1f}ms per turn")
+        print(f"{'═'*60}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the simulation sharded across processes or nodes.")
+    sub = parser.add_subparsers(dest="role", required=True)
+
+    def add_common(p):
+        p.add_argument("--agents-per-shard", type=int, default=5, help="Agents in each village")
+        p.add_argument("--seed", type=int, default=None, help="Seed for a reproducible run")
+        p.add_argument("--llm", choices=["ollama", "replay", "stub"], default="ollama", help="LLM backend")
+        p.add_argument("--replay-cache", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_replay_cache.json"),
+                       help="Cache file for --llm replay (one per shard)")
+        p.add_argument("--no-checkpoint", action="store_true", help="Disable checkpointing and checkpoint resume")
+        p.add_argument("--checkpoint-dir", default=None, help="Checkpoint directory (default: CHECKPOINT_DIR)")
+        p.add_argument("--profile-hooks", action="store_true",
+                       help="Profile the coordinator and workers on SIGUSR1 or POST /api/profile")
+
+    coord = sub.add_parser("coordinator", help="Advance turns and run global phases")
+    add_common(coord)
+    coord.add_argument("--shards", type=int, default=2, help="Number of villages / worker processes")
+    coord.add_argument("--turns", type=int, default=None, help="Stop after N turns (default: run forever)")
+    coord.add_argument("--staleness", type=int, default=0, help="How many turns a shard may run ahead (0 = lockstep)")
+    coord.add_argument("--listen", default="127.0.0.1:0", help="HOST:PORT to accept workers on")
+    coord.add_argument("--external-workers", action="store_true", help="Do not spawn local workers; wait for remote ones")
+    coord.add_argument("--sleep", type=float, default=2.0, help="Seconds to wait between turns")
+    coord.add_argument("--no-sleep", action="store_true", help="Do not wait between turns (fast-forward)")
+
+    worker = sub.add_parser("worker", help="Run one village")
+    add_common(worker)
+    worker.add_argument("--shard", type=int, required=True, help="Shard (village) index")
+    worker.add_argument("--coordinator", required=True, help="Coordinator HOST:PORT")
+
+    args = parser.parse_args()
+    if args.role == "coordinator":
+        run_coordinator(args)
+    else:
+        run_worker(args)
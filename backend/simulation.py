@@ -1,52 +1,123 @@
+import time
+_PROCESS_STARTED_AT = time.perf_counter()  # For the time-to-first-turn log
+
 from agent import Agent
 from memory import MemorySystem
-from llm_router import LLMRouter
-from database import SessionLocal, engine, Base
+from llm_router import LLMRouter, StubLLMRouter, ReplayLLMRouter, prewarm_models
+from database import SessionLocal, init_db
 from epoch_detector import detect_and_record_epoch
 from chronicle_summarizer import generate_chronicle
+from event_archive import ensure_partition_for_turn, archive_cold_partitions
+from analytics import record_fallback
+from checkpoint import Checkpointer, restore_agent
+from profiling import TurnProfiler, PROFILE_HOOKS
 import models
 import json
 import os
 import random
+import threading
+import uuid
+from typing import Optional, List
 from sandbox_utils import parse_agent_action
 
-# Ensure tables are created
-Base.metadata.create_all(bind=engine)
-
 class Simulation:
-    def __init__(self, num_agents: int = 5):
-        self.router = LLMRouter()
-        self.agents = [Agent(f"Agent-{i}", "Curious pioneer") for i in range(num_agents)]
+    def __init__(
+        self,
+        num_agents: int = 5,
+        seed: Optional[int] = None,
+        router: Optional[LLMRouter] = None,
+        start_turn: Optional[int] = None,
+        checkpointer: Optional[Checkpointer] = None,
+        name_prefix: str = "Agent",
+    ):
+        # Ensure tables are created (once per process, not on import)
+        init_db()
+
+        # A single seeded RNG drives movement, entropy rolls and agent ids so runs are reproducible
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.router = router or LLMRouter()
+        if seed is not None:
+            self.router.use_rng(self.rng)
+        self.checkpointer = checkpointer
+
+        restored = checkpointer.load() if checkpointer and start_turn is None else None
+        if restored:
+            self._restore(restored, num_agents)
+        else:
+            self.agents = [
+                Agent(f"{name_prefix}-{i}", "Curious pioneer", agent_id=self._new_agent_id())
+                for i in range(num_agents)
+            ]
 
-        # Inject memory system into agents
-        for a in self.agents:
-            a.memory = MemorySystem(agent_id=a.identity.agent_id)
+            # Inject memory system into agents
+            for a in self.agents:
+                a.memory = MemorySystem(agent_id=a.identity.agent_id, rng=self.rng)
 
         # Fix #2: Resume from the last turn stored in the DB
-        self.turn = self._resume_turn()
+        # (a checkpoint can lag the DB by the turn that was running when the process died)
+        if start_turn is not None:
+            self.turn = start_turn
+        elif restored:
+            self.turn = max(restored["turn"], resume_turn())
+        else:
+            self.turn = resume_turn()
         print(f"[Simulation] Resuming from turn {self.turn}.")
 
-    def _resume_turn(self) -> int:
-        """Read the last persisted turn from the DB to enable seamless restart."""
-        db = SessionLocal()
-        try:
-            last_event = db.query(models.SimulationEvent).order_by(
-                models.SimulationEvent.turn.desc()
-            ).first()
-            if last_event:
-                return int(last_event.turn) + 1
-            return 0
-        except Exception as e:
-            print(f"[Simulation] Could not resume turn from DB: {e}. Starting from 0.")
-            return 0
-        finally:
-            db.close()
+    def _restore(self, state: dict, num_agents: int):
+        """Rebuild agents, short-term memories, the RNG and router state from a checkpoint."""
+        # The checkpoint wins so the run stays consistent; say so when it contradicts the CLI
+        if self.seed is not None and state["seed"] != self.seed:
+            print(f"[Simulation] Warning: checkpoint was written with seed {state['seed']}, ignoring --seed {self.seed}. "
+                  f"Use --no-checkpoint or another --checkpoint-dir to start a new run.")
+        if len(state["agents"]) != num_agents:
+            print(f"[Simulation] Warning: checkpoint has {len(state['agents'])} agents, ignoring the requested {num_agents}.")
+        self.seed = state["seed"]
+        self.rng.setstate(state["rng"])
+        if self.seed is not None:
+            self.router.use_rng(self.rng)
+        self.router.set_state(state.get("router"))
+        self.agents = []
+        for data in state["agents"]:
+            agent, short_term = restore_agent(data)
+            agent.memory = MemorySystem(agent_id=agent.identity.agent_id, rng=self.rng)
+            agent.memory.short_term = short_term
+            self.agents.append(agent)
+        print(f"[Simulation] Restored {len(self.agents)} agents from checkpoint (turn {state['turn']}).")
 
+    def _new_agent_id(self) -> Optional[str]:
+        if self.seed is None:
+            return None  # Random uuid4 from AgentIdentity
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
 
     def step(self):
         """Execute one full turn in the simulation (e.g., 1 Day)"""
         print(f"--- Turn {self.turn} ---")
 
+        self.run_agent_phase()
+        run_global_phase(self.turn, self.router)
+
+        # Output current state for Sandbox View
+        self._dump_sandbox_state()
+
+        self.turn += 1
+
+        if self.checkpointer:
+            self.checkpointer.save(self)
+
+    def deliver_rumor(self, content: str):
+        """Hand a legend told in another village to one of our agents."""
+        if self.agents:
+            agent = self.rng.choice(self.agents)
+            agent.memory.add_memory(content, importance=0.6, timestamp=self.turn)
+
+    def run_agent_phase(self) -> List[str]:
+        """
+        Daily actions and reflections of this simulation's agents for self.turn.
+        Returns the legends told this turn (shared with other villages in sharded mode).
+        """
+        legends = []
+        ensure_partition_for_turn(self.turn)
         db = SessionLocal()
         try:
             # 1. Daily Actions (Local LLM Routing)
@@ -55,6 +126,7 @@ class Simulation:
 
                 if not action or "[FALLBACK]" in action:
                     print(f"[WARN] Agent {agent.identity.name} got a fallback response at turn {self.turn}. Skipping save.")
+                    record_fallback(db, self.turn, agent.identity.agent_id, "DAILY_ACTION")
                     continue
 
                 agent.memory.add_memory(action, importance=0.5, timestamp=self.turn)
@@ -65,8 +137,8 @@ class Simulation:
                 agent.state.current_action = parsed["action"]
                 agent.state.speech = parsed["speech"]
                 # Move slightly
-                agent.state.x = max(0.0, min(100.0, agent.state.x + random.uniform(-10.0, 10.0)))
-                agent.state.y = max(0.0, min(100.0, agent.state.y + random.uniform(-10.0, 10.0)))
+                agent.state.x = max(0.0, min(100.0, agent.state.x + self.rng.uniform(-10.0, 10.0)))
+                agent.state.y = max(0.0, min(100.0, agent.state.y + self.rng.uniform(-10.0, 10.0)))
 
                 # Save Daily Action to DB
                 event = models.SimulationEvent(
@@ -77,54 +149,112 @@ class Simulation:
                 )
                 db.add(event)
 
-            # 2. Nightly Reflection & Entropy Injection (Cloud LLM Routing)
+            # 2. Nightly Reflection & Entropy Injection
             # Occurs every 5 turns
             if self.turn % 5 == 0 and self.turn > 0:
+                from entropy_engine import ENTROPY_TIERED
                 print(">>> The agents are reflecting... (Entropy Injection)")
-                for agent in self.agents:
-                    summarized = agent.memory.reflect_and_summarize(current_time=self.turn)
-                    exaggerated_memory = self.router.reflect_and_hallucinate(summarized, entropy_factor=0.3)
-
-                    if not exaggerated_memory or "[FALLBACK]" in exaggerated_memory:
-                        print(f"[WARN] Reflection fallback for {agent.identity.name} at turn {self.turn}. Skipping.")
-                        continue
-
-                    # Save Reflection to DB
-                    event = models.SimulationEvent(
-                        turn=self.turn,
-                        agent_id=agent.identity.agent_id,
-                        event_type="REFLECTION",
-                        content=exaggerated_memory
-                    )
-                    db.add(event)
-
-                    # Save embedding vector to ChromaDB memory
-                    vec = self.router.extract_vector(exaggerated_memory)
-                    agent.memory.add_memory(
-                        f"[LEGEND] {exaggerated_memory}",
-                        importance=0.9,
-                        timestamp=self.turn
-                    )
+                if ENTROPY_TIERED:
+                    legends = self._reflect_tiered(db)
+                else:
+                    legends = self._reflect_per_agent(db)
 
             db.commit()
         except Exception as e:
             db.rollback()
             print(f"[ERROR] Turn {self.turn} failed: {e}")
+            legends = []
         finally:
             db.close()
+        return legends
 
-        # Phase 5: Auto-detect and record new epochs every N turns
-        detect_and_record_epoch(self.turn)
+    def _reflect_per_agent(self, db) -> List[str]:
+        """Original reflection: one smart-model call per agent (ENTROPY_TIERED=0)."""
+        legends = []
+        for agent in self.agents:
+            summarized = agent.memory.reflect_and_summarize(current_time=self.turn)
+            exaggerated_memory = self.router.reflect_and_hallucinate(summarized, entropy_factor=0.3)
 
-        # Phase 5: Generate chronicle summary every 100 turns
-        generate_chronicle(self.turn)
+            if not exaggerated_memory or "[FALLBACK]" in exaggerated_memory:
+                print(f"[WARN] Reflection fallback for {agent.identity.name} at turn {self.turn}. Skipping.")
+                record_fallback(db, self.turn, agent.identity.agent_id, "REFLECTION")
+                continue
 
-        # Output current state for Sandbox View
-        self._dump_sandbox_state()
+            # Save Reflection to DB
+            event = models.SimulationEvent(
+                turn=self.turn,
+                agent_id=agent.identity.agent_id,
+                event_type="REFLECTION",
+                content=exaggerated_memory
+            )
+            db.add(event)
 
-        self.turn += 1
+            # Save embedding vector to ChromaDB memory
+            vec = self.router.extract_vector(exaggerated_memory)
+            agent.memory.add_memory(
+                f"[LEGEND] {exaggerated_memory}",
+                importance=0.9,
+                timestamp=self.turn
+            )
+            legends.append(exaggerated_memory)
+        return legends
 
-    def _dump_sandbox_state(self):
+    def _reflect_tiered(self, db) -> List[str]:
+        """
+        Two-tier reflection. All agents' memories go through the local entropy engine in one
+        vectorized pass. Each agent keeps retelling its most distorted memory, and only the
+        retellings that just crossed ENTROPY_ESCALATION_THRESHOLD are rewritten into legends
+        by the smart model, ENTROPY_BATCH_SIZE per call.
+        """
+        from entropy_engine import default_engine, ENTROPY_BATCH_SIZE
+
+        pending = [(agent, agent.memory.pending_reflection()) for agent in self.agents]
+        engine = default_engine()
+        crossed = engine.apply([m for _, items in pending for m in items], self.turn, self.rng)
+        crossed_ids = {m.id for m in crossed}
+
+        chosen = []
+        for agent, items in pending:
+            agent.memory.store_reflection(items)
+            if items:
+                chosen.append((agent, max(items, key=lambda m: (m.id in crossed_ids, m.entropy_level, m.timestamp))))
+
+        escalated = [mem for _, mem in chosen if mem.id in crossed_ids]
+        myths = self.router.rewrite_batch([mem.content for mem in escalated], batch_size=ENTROPY_BATCH_SIZE) if escalated else []
+        myth_by_id = {mem.id: myth for mem, myth in zip(escalated, myths)}
+        if escalated:
+            print(f">>> {len(escalated)} of {len(chosen)} memories became legends "
+                  f"({-(-len(escalated) // ENTROPY_BATCH_SIZE)} LLM call(s)).")
+
+        legends = []
+        for agent, mem in chosen:
+            myth = myth_by_id.get(mem.id)
+            if myth == "":
+                print(f"[WARN] Legend rewrite fallback for {agent.identity.name} at turn {self.turn}. Keeping the local retelling.")
+                # The REFLECTION is still saved below, so count the failed rewrite under its own key
+                record_fallback(db, self.turn, agent.identity.agent_id, "REFLECTION_LLM_REWRITE")
+            reflection = myth or mem.content.removeprefix("[LEGEND] ")
+
+            # Save Reflection to DB
+            db.add(models.SimulationEvent(
+                turn=self.turn,
+                agent_id=agent.identity.agent_id,
+                event_type="REFLECTION",
+                content=reflection
+            ))
+
+            # Retold (and distorted further) at the next reflection until it becomes a legend.
+            # A legend is told once more and then left to long-term memory.
+            if myth:
+                agent.memory.add_memory(f"[LEGEND] {myth}", importance=0.9, timestamp=self.turn,
+                                        entropy_level=mem.entropy_level)
+                legends.append(myth)
+            elif mem.entropy_level < engine.threshold:
+                agent.memory.add_memory(mem.content, importance=0.9, timestamp=self.turn,
+                                        entropy_level=mem.entropy_level)
+        return legends
+
+    def sandbox_snapshot(self) -> List[dict]:
         state_data = []
         for agent in self.agents:
             state_data.append({
@@ -136,22 +266,132 @@ class Simulation:
                 "action": agent.state.current_action,
                 "speech": agent.state.speech
             })
-        
-        static_dir = os.path.join(os.path.dirname(__file__), "static")
-        os.makedirs(static_dir, exist_ok=True)
-        try:
-            with open(os.path.join(static_dir, "sandbox_state.json"), "w", encoding="utf-8") as f:
-                json.dump({"turn": self.turn, "agents": state_data}, f, ensure_ascii=False)
-        except Exception as e:
-            print(f"[WARN] Failed to write sandbox state: {e}")
+        return state_data
+
+    def _dump_sandbox_state(self):
+        write_sandbox_state(self.turn, self.sandbox_snapshot())
+
+
+def resume_turn() -> int:
+    """Read the last persisted turn from the DB to enable seamless restart."""
+    db = SessionLocal()
+    try:
+        last_event = db.query(models.SimulationEvent).order_by(
+            models.SimulationEvent.turn.desc()
+        ).first()
+        if last_event:
+            return int(last_event.turn) + 1
+        return 0
+    except Exception as e:
+        print(f"[Simulation] Could not resume turn from DB: {e}. Starting from 0.")
+        return 0
+    finally:
+        db.close()
+
+
+def run_global_phase(turn: int, router: LLMRouter):
+    """Turn-level phases that must run exactly once per turn, however many villages there are."""
+    # Phase 5: Auto-detect and record new epochs every N turns
+    detect_and_record_epoch(turn, router=router)
+
+    # Phase 5: Generate chronicle summary every 100 turns
+    generate_chronicle(turn, router=router)
+
+    # Move cold turn-range partitions out of the hot table
+    archive_cold_partitions(turn)
+
+
+def write_sandbox_state(turn: int, state_data: List[dict]):
+    static_dir = os.path.join(os.path.dirname(__file__), "static")
+    os.makedirs(static_dir, exist_ok=True)
+    try:
+        with open(os.path.join(static_dir, "sandbox_state.json"), "w", encoding="utf-8") as f:
+            json.dump({"turn": turn, "agents": state_data}, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"[WARN] Failed to write sandbox state: {e}")
+
+
+def build_router(args) -> LLMRouter:
+    if args.llm == "stub":
+        return StubLLMRouter()
+    if args.llm == "replay":
+        return ReplayLLMRouter(args.replay_cache)
+    return LLMRouter()
+
+
+def _print_throughput(sim: Simulation, turn_times: list):
+    if not turn_times:
+        return
+    elapsed = sum(turn_times)
+    ordered = sorted(turn_times)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"\n{'═'*60}")
+    print(f"[Simulation] {len(turn_times)} turns x {len(sim.agents)} agents in {elapsed:.2f}s")
+    print(f"[Simulation] {len(turn_times) / elapsed:.2f} turns/s, "
+          f"{len(turn_times) * len(sim.agents) / elapsed:.2f} agent-turns/s")
+    print(f"[Simulation] turn time: mean {elapsed / len(turn_times) * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms")
+    print(f"[Simulation] LLM calls: {sim.router.call_count}")
+    if isinstance(sim.router, ReplayLLMRouter):
+        print(f"[Simulation] replay cache: {sim.router.hits} hits, {sim.router.misses} misses")
+    print(f"{'═'*60}")
+
 
 if __name__ == "__main__":
-    import time
-    sim = Simulation(num_agents=5)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the Entropy Civil simulation.")
+    parser.add_argument("--agents", type=int, default=5, help="Number of agents")
+    parser.add_argument("--turns", type=int, default=None, help="Stop after N turns (default: run forever)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for a reproducible run")
+    parser.add_argument("--start-turn", type=int, default=None, help="Start at this turn instead of resuming from the DB")
+    parser.add_argument("--sleep", type=float, default=2.0, help="Seconds to wait between turns")
+    parser.add_argument("--no-sleep", action="store_true", help="Do not wait between turns (fast-forward)")
+    parser.add_argument("--llm", choices=["ollama", "replay", "stub"], default="ollama", help="LLM backend")
+    parser.add_argument("--no-checkpoint", action="store_true", help="Disable checkpointing and checkpoint resume")
+    parser.add_argument("--checkpoint-dir", default=None, help="Checkpoint directory (default: CHECKPOINT_DIR)")
+    parser.add_argument("--replay-cache", default=os.path.join(os.path.dirname(__file__), "llm_replay_cache.json"),
+                        help="Cache file for --llm replay")
+    parser.add_argument("--profile-hooks", action="store_true",
+                        help="Profile the next turns on SIGUSR1 or POST /api/profile (also PROFILE_HOOKS=1)")
+    args = parser.parse_args()
+
+    router = build_router(args)
+    checkpointer = None
+    if not args.no_checkpoint:
+        checkpointer = Checkpointer(args.checkpoint_dir) if args.checkpoint_dir else Checkpointer()
+    if args.llm != "stub":
+        # Load llama3.2 / gemma2 / embeddings while the DB and checkpoint are restored
+        threading.Thread(target=prewarm_models, daemon=True).start()
+    started_at = time.perf_counter()
+    sim = Simulation(num_agents=args.agents, seed=args.seed, router=router,
+                     start_turn=args.start_turn, checkpointer=checkpointer)
+    print(f"[Simulation] Ready in {(time.perf_counter() - started_at) * 1000:.1f}ms.")
+    delay = 0.0 if args.no_sleep else args.sleep
+
+    # Hooks are only installed when asked for; otherwise the loop below is untouched
+    profiler = None
+    if args.profile_hooks or PROFILE_HOOKS:
+        profiler = TurnProfiler()
+        profiler.install_signal_handler()
+
     print("Starting continuous simulation... Press Ctrl+C to stop.")
+    turn_times = []
     try:
-        while True:
+        while args.turns is None or len(turn_times) < args.turns:
+            started = time.perf_counter()
+            if profiler:
+                profiler.before_turn(sim)
             sim.step()
-            time.sleep(2)  # Wait 2 seconds between turns for readability
+            if profiler:
+                profiler.after_turn(sim)
+            turn_times.append(time.perf_counter() - started)
+            if len(turn_times) == 1:
+                print(f"[Simulation] Time to first turn: {time.perf_counter() - _PROCESS_STARTED_AT:.2f}s")
+            if delay:
+                time.sleep(delay)  # Wait between turns for readability
     except KeyboardInterrupt:
         print("Simulation paused.")
+    finally:
+        if isinstance(router, ReplayLLMRouter):
+            router.save()
+        _print_throughput(sim, turn_times)
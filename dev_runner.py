@@ -2,35 +2,92 @@ import subprocess
 import time
 import sys
 import os
+import urllib.request
+
+BACKEND_PORT = 8002
+HEALTH_URL = f"http://localhost:{BACKEND_PORT}/health"
+READY_TIMEOUT = 120       # Seconds to wait for the backend's readiness probe
+BACKOFF_INITIAL = 1.0     # First restart delay after a crash
+BACKOFF_MAX = 60.0
+HEALTHY_UPTIME = 60.0     # A process that stays up this long resets its backoff
 
 def run_backend():
-    print("Starting FastAPI Backend (Port 8002)...")
-    return subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0", "--port", "8002", "--reload"], cwd="backend")
+    print(f"Starting FastAPI Backend (Port {BACKEND_PORT})...")
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0", "--port", str(BACKEND_PORT), "--reload"], cwd="backend")
+
+SIM_SHARDS = int(os.getenv("SIM_SHARDS", "1"))  # >1 runs villages in separate worker processes
 
 def run_simulation():
+    if SIM_SHARDS > 1:
+        print(f"Starting Simulation Engine ({SIM_SHARDS} shards)...")
+        return subprocess.Popen([sys.executable, "sharding.py", "coordinator", "--shards", str(SIM_SHARDS)], cwd="backend")
     print("Starting Simulation Engine...")
     return subprocess.Popen([sys.executable, "simulation.py"], cwd="backend")
 
+def wait_until_ready(proc, timeout: float = READY_TIMEOUT) -> bool:
+    """Poll /health until the backend reports DB and ChromaDB ready (HTTP 200)."""
+    started = time.monotonic()
+    delay = 0.1
+    while time.monotonic() - started < timeout:
+        if proc.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(HEALTH_URL, timeout=2) as resp:
+                if resp.status == 200:
+                    print(f"Backend ready in {time.monotonic() - started:.1f}s.")
+                    return True
+        except Exception:
+            pass
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    print(f"Backend not ready after {timeout:.0f}s. Starting the simulation anyway.")
+    return False
+
+class Supervised:
+    """A child process restarted with exponential backoff when it exits."""
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.proc = start()
+        self.started_at = time.monotonic()
+        self.backoff = BACKOFF_INITIAL
+        self.restart_at = None
+
+    def check(self):
+        now = time.monotonic()
+        if self.proc is not None and self.proc.poll() is None:
+            if now - self.started_at >= HEALTHY_UPTIME:
+                self.backoff = BACKOFF_INITIAL
+            return
+        if self.restart_at is None:
+            print(f"{self.name} exited. Restarting in {self.backoff:.0f}s...")
+            self.restart_at = now + self.backoff
+            self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+        elif now >= self.restart_at:
+            self.proc = self.start()
+            self.started_at = now
+            self.restart_at = None
+
+    def terminate(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
 if __name__ == "__main__":
     # Check if we are in the root
     if not os.path.exists("backend"):
         print("Please run this from the project root.")
         sys.exit(1)
 
-    backend_proc = run_backend()
-    time.sleep(2) # Wait for DB init in main.py
-    sim_proc = run_simulation()
+    backend = Supervised("Backend", run_backend)
+    wait_until_ready(backend.proc)  # DB tables are created during API startup
+    simulation = Supervised("Simulation", run_simulation)
 
     try:
         while True:
-            if backend_proc.poll() is not None:
-                print("Backend crashed. Restarting...")
-                backend_proc = run_backend()
-            if sim_proc.poll() is not None:
-                print("Simulation finished/crashed. Restarting...")
-                sim_proc = run_simulation()
-            time.sleep(5)
+            backend.check()
+            simulation.check()
+            time.sleep(0.5)
     except KeyboardInterrupt:
         print("Stopping services...")
-        backend_proc.terminate()
-        sim_proc.terminate()
+        backend.terminate()
+        simulation.terminate()
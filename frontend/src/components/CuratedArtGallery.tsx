@@ -121,9 +121,17 @@ export function CuratedArtGallery() {
                             className="rounded-xl overflow-hidden relative group border border-white/10 aspect-video bg-black"
                         >
                             {epoch.image_url ? (
+                                // Variant URLs are content-hashed, so they can be cached forever.
+                                // Tiles load the 320px thumb and only switch to medium when drawn larger
+                                // (one column or high-DPI); webp/medium stay for full-size views.
                                 <img
-                                    src={`${API_BASE}${epoch.image_url}?t=${Date.now()}`} // Cache buster
+                                    src={`${API_BASE}${epoch.image_url}`}
+                                    srcSet={epoch.images?.thumb && epoch.images?.medium
+                                        ? `${API_BASE}${epoch.images.thumb} 320w, ${API_BASE}${epoch.images.medium} 1280w`
+                                        : undefined}
+                                    sizes="(min-width: 768px) 33vw, (min-width: 640px) 50vw, 100vw"
                                     alt={epoch.name}
+                                    loading="lazy"
                                     className="w-full h-full object-cover transform transition-transform duration-700 group-hover:scale-110"
                                 />
                             ) : (